@@ -17,10 +17,12 @@
 
 import os
 import re
+import StringIO
 import time
 import datetime
-import xml.dom.minidom
+import itertools
 import traceback
+import xml.etree.cElementTree as ET
 
 from starcluster import utils
 from starcluster import static
@@ -33,12 +35,53 @@ from starcluster.exception import ThreadPoolException
 SGE_STATS_DIR = os.path.join(static.STARCLUSTER_CFG_DIR, 'sge')
 DEFAULT_STATS_DIR = os.path.join(SGE_STATS_DIR, '%s')
 DEFAULT_STATS_FILE = os.path.join(DEFAULT_STATS_DIR, 'sge-stats.csv')
+ACCOUNTING_FILE = '/opt/sge6/default/common/accounting'
+# generous upper bound of the size of a record in the accounting file
+ACCOUNTING_RECORD_SIZE = 1024
+TASK_RANGE_RE = re.compile("(\d+)-?(\d+)?:?(\d+)?")
+
+
+class _LineReader(object):
+    """
+    File-like object reading from an iterable of lines (e.g. the output of
+    SSHClient.execute_stream) so that it can be parsed incrementally
+    """
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buf = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            try:
+                self._buf += next(self._lines) + '\n'
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+
+def _iterparse(xml_out):
+    """
+    Yields the (event, element) pairs of the start and end of each element in
+    xml_out, a string or an iterable of lines
+    """
+    if isinstance(xml_out, basestring):
+        source = StringIO.StringIO(xml_out)
+    else:
+        source = _LineReader(xml_out)
+    return ET.iterparse(source, events=('start', 'end'))
 
 
 class SGEStats(object):
     """
     SunGridEngine stats parser
     """
+    # job_list fields kept by parse_qstat (the ones used by the balancer)
+    JOB_FIELDS = frozenset(['JB_job_number', 'state', 'JB_submission_time',
+                            'slots', 'tasks', 'queue_name'])
+
     def __init__(self, remote_tzinfo=None):
         self.jobstat_cachesize = 200
         self.hosts = []
@@ -47,6 +90,7 @@ class SGEStats(object):
         self.jobstats = self.jobstat_cachesize * [None]
         self.max_job_id = 0
         self.remote_tzinfo = remote_tzinfo or utils.get_utc_now().tzinfo
+        self._index_jobs()
 
     @property
     def first_job_id(self):
@@ -61,55 +105,105 @@ class SGEStats(object):
     def parse_qhost(self, qhost_out, additional_config={}):
         """
         this function parses qhost -xml output and makes a neat array
-        takes in a string, so we can pipe in output from ssh.exec('qhost -xml')
+        takes in a string or an iterable of lines, so we can pipe in output
+        from ssh.execute_stream('qhost -xml')
         """
         self.hosts = []  # clear the old hosts
-        doc = xml.dom.minidom.parseString(qhost_out)
-        for h in doc.getElementsByTagName("host"):
-            name = h.getAttribute("name")
+        elems = []
+        for event, elem in _iterparse(qhost_out):
+            if event == 'start':
+                elems.append(elem)
+                continue
+            elems.pop()
+            if elem.tag != 'host':
+                continue
+            name = elem.get("name")
             hash = {"name": name}
-            for stat in h.getElementsByTagName("hostvalue"):
-                for hvalue in stat.childNodes:
-                    attr = stat.attributes['name'].value
-                    val = ""
-                    if hvalue.nodeType == xml.dom.minidom.Node.TEXT_NODE:
-                        val = hvalue.data
-                    hash[attr] = val
+            for stat in elem.iter("hostvalue"):
+                if stat.text is not None:
+                    hash[stat.get('name')] = stat.text
             if hash['name'] != u'global':
                 if name in additional_config:
                     for k, v in additional_config[name].items():
                         hash[k] = v
                 self.hosts.append(hash)
+            # free each host once parsed
+            del elems[-1][-1]
         return self.hosts
 
     def parse_qstat(self, qstat_out):
         """
-        This method parses qstat -xml output and makes a neat array
+        This method parses qstat -xml output, a string or an iterable of
+        lines, and makes a neat array. Only the JOB_FIELDS of each job are
+        kept.
+
+        A task array job is a single entry whose 'num_tasks' is the number of
+        its tasks (see count_tasks and count_slots).
         """
         self.jobs = []  # clear the old jobs
         self.queues = {}  # clear the old queues
-        doc = xml.dom.minidom.parseString(qstat_out)
-        for q in doc.getElementsByTagName("Queue-List"):
-            name = q.getElementsByTagName("name")[0].childNodes[0].data
-            slots = q.getElementsByTagName("slots_total")[0].childNodes[0].data
-            self.queues[name] = dict(slots=int(slots))
-            for job in q.getElementsByTagName("job_list"):
-                self.jobs.extend(self._parse_job(job, queue_name=name))
-        for job in doc.getElementsByTagName("job_list"):
-            if job.parentNode.nodeName == 'job_info':
-                self.jobs.extend(self._parse_job(job))
+        elems = []
+        queue_name = slots = None
+        for event, elem in _iterparse(qstat_out):
+            if event == 'start':
+                elems.append(elem)
+                continue
+            elems.pop()
+            parent = elems[-1].tag if elems else None
+            if elem.tag == 'job_list':
+                if parent == 'Queue-List':
+                    self.jobs.append(self._parse_job(elem,
+                                                     queue_name=queue_name))
+                elif parent == 'job_info':
+                    self.jobs.append(self._parse_job(elem))
+                # free each job once parsed
+                del elems[-1][-1]
+            elif parent == 'Queue-List' and elem.tag == 'name':
+                queue_name = elem.text
+            elif parent == 'Queue-List' and elem.tag == 'slots_total':
+                slots = elem.text
+            elif elem.tag == 'Queue-List':
+                self.queues[queue_name] = dict(slots=int(slots))
+                queue_name = slots = None
+                del elems[-1][-1]
+        self._index_jobs()
         return self.jobs
 
+    def _index_jobs(self):
+        """
+        Builds the indexes of self.jobs used by the queries below (once per
+        parse_qstat)
+        """
+        self._running_jobs = []
+        self._queued_jobs = []
+        self._jobs_by_id = {}
+        self._busy_hosts = set()
+        self._oldest_submission_time = None
+        for j in self.jobs:
+            self._jobs_by_id.setdefault(j.get('JB_job_number'), j)
+            if j['job_state'] == u'running':
+                self._running_jobs.append(j)
+            elif j['job_state'] == u'pending' and j.get('state') == u'qw':
+                self._queued_jobs.append(j)
+                # ISO 8601 times of the same format sort chronologically
+                st = j.get('JB_submission_time')
+                if st and (self._oldest_submission_time is None or
+                           st < self._oldest_submission_time):
+                    self._oldest_submission_time = st
+            queue_name = j.get('queue_name')
+            if queue_name:
+                host = queue_name.split('@', 1)[-1]
+                self._busy_hosts.add(host)
+                self._busy_hosts.add(host.split('.', 1)[0])
+
     def _parse_job(self, job, queue_name=None):
-        jstate = job.getAttribute("state")
+        jstate = job.get("state")
         jdict = dict(job_state=jstate, queue_name=queue_name)
-        for node in job.childNodes:
-            if node.nodeType == xml.dom.minidom.Node.ELEMENT_NODE:
-                for child in node.childNodes:
-                    jdict[node.nodeName] = child.data
-        num_tasks = self._count_tasks(jdict)
-        log.debug("Job contains %d tasks" % num_tasks)
-        return [jdict] * num_tasks
+        for node in job:
+            if node.tag in self.JOB_FIELDS and node.text is not None:
+                jdict[node.tag] = node.text
+        jdict['num_tasks'] = self._count_tasks(jdict)
+        return jdict
 
     def _count_tasks(self, jdict):
         """
@@ -120,17 +214,13 @@ class SGEStats(object):
         num_tasks = 0
         for task in tasks:
             if '-' in task:
-                regex = "(\d+)-?(\d+)?:?(\d+)?"
-                r = re.compile(regex)
-                start, end, step = r.match(task).groups()
+                start, end, step = TASK_RANGE_RE.match(task).groups()
                 start = int(start)
                 end = int(end)
                 step = int(step) if step else 1
                 num_tasks += (end - start) / step + 1
             else:
                 num_tasks += 1
-        log.debug("task array job has %s tasks (tasks: %s)" %
-                  (num_tasks, tasks))
         return num_tasks
 
     def qacct_to_datetime_tuple(self, qacct):
@@ -146,15 +236,17 @@ class SGEStats(object):
         """
         This method parses qacct -j output and makes a neat array and
         calculates some statistics.
-        Takes the string to parse, and a datetime object of the remote
-        host's current time.
+        Takes the string (or iterable of lines) to parse, and a datetime
+        object of the remote host's current time.
         """
         job_id = None
         qd = None
         start = None
         end = None
         counter = 0
-        lines = string.split('\n')
+        lines = string
+        if isinstance(string, basestring):
+            lines = string.split('\n')
         for l in lines:
             l = l.strip()
             if l.find('jobnumber') != -1:
@@ -185,6 +277,48 @@ class SGEStats(object):
                   len(self.jobstats))
         return self.jobstats
 
+    def accounting_to_datetime_tuple(self, epoch):
+        """
+        Takes a time of the SGE accounting file, in seconds since the epoch
+        (milliseconds for newer SGE versions), and makes a datetime tuple
+        """
+        epoch = int(epoch)
+        if epoch > 1e11:
+            epoch /= 1000.0
+        return datetime.datetime.fromtimestamp(epoch, self.remote_tzinfo)
+
+    def parse_accounting(self, lines, since=None):
+        """
+        This method parses records of the SGE accounting file, one
+        colon-separated job per line (see accounting(5)), into the jobstats
+        ring buffer. Takes an iterable of lines and, optionally, a datetime
+        object: jobs that ended before it are skipped.
+        """
+        counter = 0
+        for l in lines:
+            if not l or l.startswith('#'):
+                continue
+            fields = l.split(':')
+            try:
+                job_id = int(fields[5])
+                times = [int(f) for f in fields[8:11]]
+            except (IndexError, ValueError):
+                log.debug("Skipping invalid accounting record: %s" % l)
+                continue
+            if len(times) != 3 or not all(times):
+                # the job was deleted before it started
+                continue
+            qd, start, end = [self.accounting_to_datetime_tuple(t)
+                              for t in times]
+            if since and end < since:
+                continue
+            self.max_job_id = max(self.max_job_id, job_id)
+            hash = {'queued': qd, 'start': start, 'end': end}
+            self.jobstats[job_id % self.jobstat_cachesize] = hash
+            counter += 1
+        log.debug("added %d new jobs" % counter)
+        return self.jobstats
+
     def is_jobstats_empty(self):
         """
         This function will return True if half of the queue is empty, False if
@@ -192,25 +326,31 @@ class SGEStats(object):
         """
         return self.max_job_id < (self.jobstat_cachesize * 0.3)
 
+    def count_tasks(self, jobs):
+        """
+        Returns the number of tasks of the jobs in jobs (e.g. the result of
+        get_queued_jobs) counting each task of task array jobs
+        """
+        return sum([j.get('num_tasks', 1) for j in jobs])
+
+    def count_slots(self, jobs):
+        """
+        Returns the number of slots used or requested by all the tasks of the
+        jobs in jobs
+        """
+        return sum([int(j['slots']) * j.get('num_tasks', 1) for j in jobs])
+
     def get_running_jobs(self):
         """
         returns an array of the running jobs, values stored in dictionary
         """
-        running = []
-        for j in self.jobs:
-            if j['job_state'] == u'running':
-                running.append(j)
-        return running
+        return self._running_jobs
 
     def get_queued_jobs(self):
         """
         returns an array of the queued jobs, values stored in dictionary
         """
-        queued = []
-        for j in self.jobs:
-            if j['job_state'] == u'pending' and j['state'] == u'qw':
-                queued.append(j)
-        return queued
+        return self._queued_jobs
 
     def count_hosts(self):
         """
@@ -253,11 +393,10 @@ class SGEStats(object):
         This returns the age of the oldest job in the queue in normal waiting
         state
         """
-        for j in self.jobs:
-            if 'JB_submission_time' in j and j['state'] == 'qw':
-                st = j['JB_submission_time']
-                dt = utils.iso_to_datetime_tuple(st)
-                return dt.replace(tzinfo=self.remote_tzinfo)
+        st = self._oldest_submission_time
+        if st:
+            dt = utils.iso_to_datetime_tuple(st)
+            return dt.replace(tzinfo=self.remote_tzinfo)
         # todo: throw a "no queued jobs" exception
 
     def is_node_working(self, node):
@@ -265,12 +404,9 @@ class SGEStats(object):
         This function returns true if the node is currently working on a task,
         or false if the node is currently idle.
         """
-        nodename = node.alias
-        for j in self.jobs:
-            qn = j.get('queue_name', '')
-            if nodename in qn:
-                log.debug("Node %s is working" % node.alias)
-                return True
+        if node.alias in self._busy_hosts:
+            log.debug("Node %s is working" % node.alias)
+            return True
         log.debug("Node %s is IDLE" % node.id)
         return False
 
@@ -279,10 +415,9 @@ class SGEStats(object):
         returns the number of slots requested for the given job id
         returns None if job_id is invalid
         """
-        ujid = unicode(job_id)
-        for j in self.jobs:
-            if j['JB_job_number'] == ujid:
-                return int(j['slots'])
+        j = self._jobs_by_id.get(unicode(job_id))
+        if j is not None:
+            return int(j['slots'])
 
     def avg_job_duration(self):
         count = 0
@@ -350,9 +485,9 @@ class SGEStats(object):
         # second field is the number of hosts
         bits.append(self.count_hosts())
         # third field is # of running jobs
-        bits.append(len(self.get_running_jobs()))
+        bits.append(self.count_tasks(self.get_running_jobs()))
         # fourth field is # of queued jobs
-        bits.append(len(self.get_queued_jobs()))
+        bits.append(self.count_tasks(self.get_queued_jobs()))
         # fifth field is total # slots
         bits.append(self.count_total_slots())
         # sixth field is average job duration
@@ -429,6 +564,10 @@ class SGELoadBalancer(LoadBalancer):
     How many hours qacct should look back to gather past job data. lower
     values minimize data transfer
     lookback_window = 3
+
+    How often (in seconds) to re-measure the master's clock offset. All
+    remote times in between are computed locally from the last offset
+    clock_sync_interval = 600
     """
 
     def __init__(self, interval=60, max_nodes=None, wait_time=900,
@@ -436,11 +575,16 @@ class SGELoadBalancer(LoadBalancer):
                  min_nodes=None, kill_cluster=False, plot_stats=False,
                  plot_output_dir=None, dump_stats=False, stats_file=None,
                  reboot_interval=10, n_reboot_restart=False,
-                 ignore_grp=False, instance_type=None, spot_bid=None):
+                 ignore_grp=False, instance_type=None, spot_bid=None,
+                 clock_sync_interval=600):
         self._cluster = None
         self._keep_polling = True
         self._visualizer = None
         self._stat = None
+        self._accounting_offset = None
+        self._clock_offset = None
+        self._clock_synced = None
+        self._clock_tzinfo = None
         self.__last_cluster_mod_time = utils.get_utc_now()
         self.polling_interval = interval
         self.kill_after = kill_after
@@ -465,6 +609,7 @@ class SGELoadBalancer(LoadBalancer):
         self.n_reboot_restart = n_reboot_restart
         self._instance_type = instance_type
         self._spot_bid = spot_bid
+        self.clock_sync_interval = clock_sync_interval
 
     @property
     def stat(self):
@@ -518,58 +663,106 @@ class SGELoadBalancer(LoadBalancer):
             except IOError, e:
                 raise exception.BaseException(str(e))
 
-    def get_remote_time(self):
+    def get_remote_time(self, refresh=False):
         """
-        This function remotely executes 'date' on the master node
-        and returns a datetime object with the master's time
-        instead of fetching it from local machine, maybe inaccurate.
+        Returns a datetime object with the master's time instead of the
+        local machine's, which may be inaccurate.
+
+        The master's clock offset and time zone are measured by remotely
+        executing 'date' at most once every clock_sync_interval seconds (or
+        when refresh=True) and all other remote times are computed locally
+        from that offset.
         """
+        if refresh or self._clock_offset is None or \
+           utils.get_utc_now() - self._clock_synced >= datetime.timedelta(
+                seconds=self.clock_sync_interval):
+            self._sync_remote_clock()
+        now = utils.get_utc_now() + self._clock_offset
+        return now.astimezone(self._clock_tzinfo)
+
+    def _sync_remote_clock(self):
         cmd = 'date --iso-8601=seconds'
         date_str = '\n'.join(self._cluster.master_node.ssh.execute(cmd))
         d = utils.iso_to_datetime_tuple(date_str)
+        self._clock_synced = utils.get_utc_now()
+        self._clock_offset = d - self._clock_synced
+        self._clock_tzinfo = d.tzinfo
         if self._stat:
             self._stat.remote_tzinfo = d.tzinfo
-        return d
-
-    def get_qatime(self, now):
-        """
-        This function takes the lookback window and creates a string
-        representation of the past few hours, to feed to qacct to
-        limit the dataset qacct returns.
-        """
-        if self.stat.is_jobstats_empty():
-            log.info("Loading full job history")
-            temp_lookback_window = self.lookback_window * 60 * 60
-        else:
-            temp_lookback_window = self.polling_interval
-        log.debug("getting past %d seconds worth of job history" %
-                  temp_lookback_window)
-        now = now - datetime.timedelta(seconds=temp_lookback_window + 1)
-        return now.strftime("%Y%m%d%H%M")
+        log.debug("master clock offset: %s" % self._clock_offset)
 
     def _get_stats(self):
         master = self._cluster.master_node
         now = self.get_remote_time()
-        qatime = self.get_qatime(now)
-        qacct_cmd = 'qacct -j -b ' + qatime
         qstat_cmd = 'qstat -u \* -xml -f -r'
-        qhostxml = '\n'.join(master.ssh.execute('qhost -xml'))
-        qstatxml = '\n'.join(master.ssh.execute(qstat_cmd))
+        # qhost and qstat are parsed as their output is received
+        self.stat.parse_qhost(master.ssh.execute_stream('qhost -xml'))
+        self.stat.parse_qstat(master.ssh.execute_stream(qstat_cmd))
         try:
-            qacct = '\n'.join(master.ssh.execute(qacct_cmd))
+            self._parse_new_accounting(master, now)
         except exception.RemoteCommandFailed:
-            if master.ssh.isfile('/opt/sge6/default/common/accounting'):
+            if master.ssh.isfile(ACCOUNTING_FILE):
                 raise
             else:
                 log.info("No jobs have completed yet!")
-                qacct = ''
-        self.stat.parse_qhost(qhostxml)
-        self.stat.parse_qstat(qstatxml)
-        self.stat.parse_qacct(qacct, now)
-        log.debug("sizes: qhost: %d, qstat: %d, qacct: %d" %
-                  (len(qhostxml), len(qstatxml), len(qacct)))
+        log.debug("parsed: hosts: %d, jobs: %d" %
+                  (len(self.stat.hosts), len(self.stat.jobs)))
         return self.stat
 
+    def _parse_new_accounting(self, master, now):
+        """
+        Tails the SGE accounting file on the master and parses the records
+        appended to it since the last poll. The first poll only reads enough
+        of the end of the file to fill the jobstats cache with the jobs that
+        ended within the lookback window.
+        """
+        size = int(master.ssh.execute('stat -c %%s %s' % ACCOUNTING_FILE)[0])
+        offset = self._accounting_offset
+        since = None
+        skip = 0
+        if offset is None:
+            log.info("Loading job history")
+            since = now - datetime.timedelta(hours=self.lookback_window)
+            offset = max(0, size - self.stat.jobstat_cachesize *
+                         ACCOUNTING_RECORD_SIZE)
+            # the window most likely starts in the middle of a record
+            skip = int(offset > 0)
+        elif size < offset:
+            log.info("Accounting file was rotated, reading it from the start")
+            offset = 0
+        self._accounting_offset = offset
+        if size == offset:
+            return
+        log.debug("reading %d bytes of job history" % (size - offset))
+        # prefix each line with its length in bytes as the output lines are
+        # stripped of their trailing whitespace
+        cmd = 'tail -c +%d %s | head -c %d' % (offset + 1, ACCOUNTING_FILE,
+                                               size - offset)
+        cmd += " | LC_ALL=C awk '{ print length($0) \":\" $0 }'"
+        lines = self._complete_lines(master.ssh.execute_stream(cmd), size)
+        self.stat.parse_accounting(itertools.islice(lines, skip, None),
+                                   since=since)
+
+    def _complete_lines(self, lines, size):
+        """
+        Yields the lines of the accounting file read up to size bytes from
+        the current offset, each prefixed with its length, advancing the
+        offset past each of them. A last line that has not been completely
+        written yet is left to be read on the next poll.
+        """
+        for output in lines:
+            nbytes, sep, line = output.partition(':')
+            if not sep or not nbytes.isdigit():
+                log.debug("Ignoring unexpected output: %s" % output)
+                continue
+            # the line's bytes and its newline
+            nbytes = int(nbytes) + 1
+            if self._accounting_offset + nbytes > size:
+                log.debug("Leaving incomplete accounting record for later")
+                return
+            self._accounting_offset += nbytes
+            yield line
+
     @utils.print_timing("Fetching SGE stats", debug=True)
     def get_stats(self):
         """
@@ -646,6 +839,7 @@ class SGELoadBalancer(LoadBalancer):
         if self.plot_stats:
             log.info("Plotting stats to directory: %s" % self.plot_output_dir)
         while(self._keep_polling):
+            cluster.invalidate_nodes()
             cluster.recover(reboot_interval=self.reboot_interval,
                             n_reboot_restart=self.n_reboot_restart)
             cluster.clean()
@@ -657,7 +851,8 @@ class SGELoadBalancer(LoadBalancer):
             log.info("Execution hosts: %d" % len(self.stat.hosts), extra=raw)
             log.info("Execution slots: %d" % self.stat.count_total_slots(),
                      extra=raw)
-            log.info("Queued jobs: %d" % len(self.stat.get_queued_jobs()),
+            log.info("Queued jobs: %d" %
+                     self.stat.count_tasks(self.stat.get_queued_jobs()),
                      extra=raw)
             oldest_queued_job_age = self.stat.oldest_queued_job_age()
             if oldest_queued_job_age:
@@ -722,8 +917,8 @@ class SGELoadBalancer(LoadBalancer):
         if not self.has_cluster_stabilized() and total_slots > 0:
             return False
         running_jobs = self.stat.get_running_jobs()
-        used_slots = sum([int(j['slots']) for j in running_jobs])
-        qw_slots = sum([int(j['slots']) for j in queued_jobs])
+        used_slots = self.stat.count_slots(running_jobs)
+        qw_slots = self.stat.count_slots(queued_jobs)
         slots_per_host = self.stat.slots_per_host()
         avail_slots = total_slots - used_slots
         need_to_add = 0
@@ -0,0 +1,126 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Run a command on many nodes at once
+"""
+import time
+import pipes
+import threading
+
+from starcluster import exception
+from starcluster.logger import log
+
+
+class BroadcastResult(object):
+    """
+    Result of running a command on one node with broadcast()
+
+    exit_status is None if the command could not be run (see error)
+    """
+    def __init__(self, node, exit_status=None, output=None, elapsed=None,
+                 error=None):
+        self.node = node
+        self.exit_status = exit_status
+        self.output = output or []
+        self.elapsed = elapsed
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.exit_status == 0
+
+    def __repr__(self):
+        return '<BroadcastResult: %s (status: %s, %.1fs)>' % (
+            self.node.alias, self.exit_status, self.elapsed or 0)
+
+
+def broadcast(nodes, command, pool, max_parallel=None, timeout=None,
+              output_fn=None, ignore_exit_status=True, source_profile=True):
+    """
+    Run command on all nodes at once and return a BroadcastResult per node,
+    in the same order as nodes
+
+    pool - ThreadPool to run the command on each node
+    max_parallel - max number of nodes running the command at the same time
+                   (default: as many as the pool allows)
+    timeout - kill the command on the nodes where it runs longer than timeout
+              seconds (exit status 124)
+    output_fn - called with (node, line) for each output line of each node as
+                soon as it is received
+    ignore_exit_status - if False raise RemoteCommandFailed once all the
+                         nodes are done if the command failed on some of them
+    """
+    slots = None
+    if max_parallel:
+        slots = threading.BoundedSemaphore(max_parallel)
+    remote_command = command
+    if timeout:
+        remote_command = 'timeout %d bash -c %s' % (timeout,
+                                                    pipes.quote(command))
+
+    def run(node):
+        if slots:
+            slots.acquire()
+        start = time.time()
+        result = BroadcastResult(node)
+        try:
+            lines = node.ssh.execute_stream(remote_command,
+                                            ignore_exit_status=True,
+                                            source_profile=source_profile)
+            for line in lines:
+                result.output.append(line)
+                if output_fn:
+                    output_fn(node, line)
+            result.exit_status = node.ssh.get_last_status()
+        except Exception, e:
+            log.debug("broadcast failed on %s" % node.alias, exc_info=True)
+            result.error = str(e) or e.__class__.__name__
+        finally:
+            result.elapsed = time.time() - start
+            if slots:
+                slots.release()
+        return result
+
+    results = pool.map(run, nodes, jobid_fn=lambda n: n.alias)
+    failed = [r for r in results if not r.ok]
+    if failed and not ignore_exit_status:
+        first = failed[0]
+        msg = "remote command '%s' failed on %d node(s): %s" % (
+            command, len(failed),
+            ', '.join(['%s (%s)' % (r.node.alias, r.error or r.exit_status)
+                       for r in failed]))
+        raise exception.RemoteCommandFailed(msg, command, first.exit_status,
+                                            '\n'.join(first.output))
+    return results
+
+
+def group_broadcast_results(results):
+    """
+    Groups broadcast() results having the same exit status and output.
+    Returns a list of (exit status, output lines, results) in the order each
+    group first appears in results.
+    """
+    groups = []
+    by_key = {}
+    for result in results:
+        key = (result.exit_status, result.error, tuple(result.output))
+        if key not in by_key:
+            by_key[key] = []
+            groups.append((key, by_key[key]))
+        by_key[key].append(result)
+    return [(key[0], list(key[2]), group) for key, group in groups]
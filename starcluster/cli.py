@@ -35,6 +35,7 @@ from starcluster import static
 from starcluster import logger
 from starcluster import commands
 from starcluster import exception
+from starcluster import threadpool
 from starcluster import completion
 from starcluster.logger import log, console
 from starcluster import __version__
@@ -96,6 +97,9 @@ class StarClusterCLI(object):
         except exception.ConfigError, e:
             log.error(e.msg)
             sys.exit(1)
+        threadpool.configure_shared_pool(
+            max_threads=cfg.globals.get('max_threads'),
+            max_host_channels=cfg.globals.get('max_host_channels'))
         gopts.CONFIG = cfg
         # Parse command arguments and invoke command.
         subcmdname, subargs = args[0], args[1:]
@@ -23,6 +23,7 @@ import pprint
 import warnings
 import datetime
 import json
+import threading
 from collections import Counter
 
 import iptools
@@ -33,6 +34,7 @@ from starcluster import sshutils
 from starcluster import managers
 from starcluster import userdata
 from starcluster import deathrow
+from starcluster import broadcast
 from starcluster import exception
 from starcluster import threadpool
 from starcluster import validators
@@ -403,6 +405,11 @@ class ClusterManager(managers.Manager):
 
 class Cluster(object):
 
+    # node attributes that uniquely identify a node (see Cluster.get_node)
+    NODE_IDENTIFIERS = ['alias', 'id', 'spot_id', 'dns_name', 'ip_address',
+                        'private_ip_address', 'public_dns_name',
+                        'private_dns_name']
+
     def __init__(self,
                  ec2_conn=None,
                  spot_bid=None,
@@ -425,7 +432,7 @@ class Cluster(object):
                  userdata_scripts=[],
                  refresh_interval=30,
                  disable_queue=False,
-                 num_threads=20,
+                 num_threads=None,
                  disable_threads=False,
                  cluster_group=None,
                  force_spot_master=False,
@@ -436,11 +443,14 @@ class Cluster(object):
                  config_on_master=False,
                  dns_suffix=None,
                  node_instance_array=[],
-                 impaired_threshold_sec=120):
+                 impaired_threshold_sec=120,
+                 nodes_cache_ttl=10,
+                 hosts_mode='etc_hosts',
+                 configure_workers=1):
         # update class vars with given vars
         _vars = locals().copy()
         for k in ['cluster_group', 'ec2_conn', 'node_image_id',
-                  'node_instance_type', 'spot_bid']:
+                  'node_instance_type', 'spot_bid', 'num_threads']:
             del _vars[k]
         self.__dict__.update(_vars)
 
@@ -458,12 +468,16 @@ class Cluster(object):
         self.dns_prefix = dns_prefix and cluster_tag
         self.refresh_interval = refresh_interval
         self.disable_queue = disable_queue
-        self.num_threads = num_threads
+        if num_threads is not None:
+            threadpool.configure_num_threads(num_threads)
         self.disable_threads = disable_threads
         self.force_spot_master = force_spot_master
         self.disable_cloudinit = disable_cloudinit
         self.plugins_order = plugins_order
         self.dns_suffix = dns_suffix and cluster_tag
+        self.nodes_cache_ttl = nodes_cache_ttl
+        self.hosts_mode = hosts_mode
+        self.configure_workers = configure_workers
         if node_instance_array:
             try:
                 assert node_image_id is None
@@ -480,6 +494,9 @@ class Cluster(object):
         self._zone = None
         self._master = None
         self._nodes = []
+        self._nodes_index = {}
+        self._nodes_timestamp = None
+        self._nodes_lock = threading.RLock()
         self._pool = None
         self._progress_bar = None
         self.__default_plugin = None
@@ -572,15 +589,14 @@ class Cluster(object):
         if not self.__default_plugin:
             self.__default_plugin = clustersetup.DefaultClusterSetup(
                 disable_threads=self.disable_threads,
-                num_threads=self.num_threads)
+                hosts_mode=self.hosts_mode)
         return self.__default_plugin
 
     @property
     def _sge_plugin(self):
         if not self.__sge_plugin:
             self.__sge_plugin = sge.SGEPlugin(
-                disable_threads=self.disable_threads,
-                num_threads=self.num_threads)
+                disable_threads=self.disable_threads)
         return self.__sge_plugin
 
     def load_volumes(self, vols):
@@ -802,7 +818,9 @@ class Cluster(object):
                              disable_queue=self.disable_queue,
                              disable_cloudinit=self.disable_cloudinit,
                              plugins_order=self.plugins_order,
-                             dns_suffix=self.dns_suffix)
+                             dns_suffix=self.dns_suffix,
+                             hosts_mode=self.hosts_mode,
+                             configure_workers=self.configure_workers)
         user_settings = dict(cluster_user=self.cluster_user,
                              cluster_shell=self.cluster_shell,
                              keyname=self.keyname)
@@ -893,8 +911,34 @@ class Cluster(object):
         tmp_aliases = Counter(aliases)
         return filter(lambda k: tmp_aliases[k] > 1, tmp_aliases)
 
+    def invalidate_nodes(self):
+        """
+        Discard the current node inventory snapshot so that the next access to
+        Cluster.nodes queries EC2 again. Must be called after any operation
+        that changes the cluster's membership or the nodes' state.
+        """
+        with self._nodes_lock:
+            self._nodes_timestamp = None
+
+    def _is_nodes_cache_valid(self):
+        if self._nodes_timestamp is None:
+            return False
+        age = time.time() - self._nodes_timestamp
+        return age < (self.nodes_cache_ttl or 0)
+
     @property
     def nodes(self):
+        """
+        Returns the list of pending/running nodes in this cluster sorted by
+        alias. The list is a snapshot that is refreshed from EC2 at most once
+        every nodes_cache_ttl seconds (see invalidate_nodes)
+        """
+        with self._nodes_lock:
+            if not self._is_nodes_cache_valid():
+                self._refresh_nodes()
+            return self._nodes
+
+    def _refresh_nodes(self):
         states = ['pending', 'running']
         filters = {'instance-state-name': states,
                    'instance.group-name': self._security_group}
@@ -926,27 +970,31 @@ class Cluster(object):
             NodeManager.nodes_id_ignore.remove(id)
         del to_remove
 
-        remove_nodes = [n for n in self._nodes if n.id not in current_ids]
-        for node in remove_nodes:
-            self._nodes.remove(node)
-        # update node cache with latest instance data from EC2
-        existing_nodes = dict([(n.id, n) for n in self._nodes])
+        # update node cache with latest instance data from EC2. A new list is
+        # built so that threads iterating over a previous snapshot are not
+        # affected by the refresh. Cached nodes that are not in the current
+        # node list from EC2 are dropped.
+        existing_nodes = dict([(n.id, n) for n in self._nodes
+                               if n.id in current_ids])
         log.debug('existing nodes: %s' % existing_nodes)
+        _nodes = []
         for node in nodes:
             if node.id in existing_nodes:
                 log.debug('updating existing node %s in self._nodes' % node.id)
                 enode = existing_nodes.get(node.id)
                 enode.key_location = self.key_location
                 enode.instance = node
+                _nodes.append(enode)
             else:
                 log.debug('adding node %s to self._nodes list' % node.id)
                 n = Node(node, self.key_location)
                 if n.is_master():
                     self._master = n
-                    self._nodes.insert(0, n)
-                else:
-                    self._nodes.append(n)
-        self._nodes.sort(key=lambda n: n.alias)
+                _nodes.append(n)
+        _nodes.sort(key=lambda n: n.alias)
+        self._nodes = _nodes
+        self._nodes_index = self._build_node_index(self._nodes)
+        self._nodes_timestamp = time.time()
         log.debug('returning self._nodes = %s' % self._nodes)
         return self._nodes
 
@@ -961,45 +1009,59 @@ class Cluster(object):
             _nodes = filter(lambda n: n.id in nodes_ids, _nodes)
         return _nodes
 
+    @classmethod
+    def _build_node_index(cls, nodes):
+        """
+        Returns a dictionary mapping every identifier in NODE_IDENTIFIERS of
+        each node in nodes to the node itself. When two nodes share an
+        identifier the first one in nodes wins.
+        """
+        index = {}
+        for node in nodes:
+            for attr in cls.NODE_IDENTIFIERS:
+                key = getattr(node, attr)
+                if key:
+                    index.setdefault(key, node)
+        return index
+
+    def _get_node_index(self, nodes=None):
+        if nodes:
+            return self._build_node_index(nodes)
+        with self._nodes_lock:
+            self.nodes
+            return self._nodes_index
+
     def get_node(self, identifier, nodes=None):
         """
         Returns a node if the identifier specified matches any unique instance
         attribute (e.g. instance id, alias, spot id, dns name, private ip,
         public ip, etc.)
+
+        If nodes is specified only those nodes are searched, otherwise the
+        current cluster node snapshot is used.
         """
-        nodes = nodes or self.nodes
-        for node in self.nodes:
-            if node.alias == identifier:
-                return node
-            if node.id == identifier:
-                return node
-            if node.spot_id == identifier:
-                return node
-            if node.dns_name == identifier:
-                return node
-            if node.ip_address == identifier:
-                return node
-            if node.private_ip_address == identifier:
-                return node
-            if node.public_dns_name == identifier:
-                return node
-            if node.private_dns_name == identifier:
-                return node
-        raise exception.InstanceDoesNotExist(identifier, label='node')
+        return self._lookup_node(identifier, self._get_node_index(nodes))
+
+    def _lookup_node(self, identifier, index):
+        node = index.get(identifier)
+        if node is None:
+            raise exception.InstanceDoesNotExist(identifier, label='node')
+        return node
 
     def get_nodes(self, identifiers, nodes=None):
         """
         Same as get_node but takes a list of identifiers and returns a list of
         nodes.
         """
-        nodes = nodes or self.nodes
+        index = self._get_node_index(nodes)
         node_list = []
+        node_ids = set()
         for i in identifiers:
-            n = self.get_node(i, nodes=nodes)
-            if n in node_list:
+            n = self._lookup_node(i, index)
+            if n.id in node_ids:
                 continue
-            else:
-                node_list.append(n)
+            node_ids.add(n.id)
+            node_list.append(n)
         return node_list
 
     def get_node_by_dns_name(self, dns_name, nodes=None):
@@ -1215,6 +1277,7 @@ class Cluster(object):
                 resvs.extend(self.ec2.request_instances(image_id, **kwargs))
         else:
             resvs.append(self.ec2.request_instances(image_id, **kwargs))
+        self.invalidate_nodes()
         for resv in resvs:
             log.info(str(resv), extra=dict(__raw__=True))
         return resvs
@@ -1281,9 +1344,8 @@ class Cluster(object):
         if no_create:
             self.wait_for_cluster(msg="Waiting for node(s) to come up...")
             log.debug("Adding node(s): %s" % aliases)
-            for alias in aliases:
-                node = self.get_node(alias)
-                self.run_plugins(method_name="on_add_node", node=node)
+            self.run_plugins(method_name="on_add_nodes",
+                             node=self.get_nodes(aliases))
         else:
             if self.subnet_ids:
                 subnet = None
@@ -1309,11 +1371,13 @@ class Cluster(object):
             if spot_bid or self.spot_bid:
                 streaming_add(self, spots=resp,
                               reboot_interval=reboot_interval,
-                              n_reboot_restart=n_reboot_restart)
+                              n_reboot_restart=n_reboot_restart,
+                              max_configure_workers=self.configure_workers)
             else:
                 streaming_add(self, instances=resp[0].instances,
                               reboot_interval=reboot_interval,
-                              n_reboot_restart=n_reboot_restart)
+                              n_reboot_restart=n_reboot_restart,
+                              max_configure_workers=self.configure_workers)
 
         if all([not no_create, spot_bid, reboot_interval, n_reboot_restart]):
             # this will recreate the spot instances that might have died in
@@ -1323,7 +1387,7 @@ class Cluster(object):
                 for alias in aliases:
                     # verify all nodes were correctly added
                     try:
-                        self.get_node_by_alias(alias)
+                        self.get_node(alias)
                     except exception.InstanceDoesNotExist:
                         try_again_aliases.append(alias)
                 if try_again_aliases:
@@ -1337,7 +1401,8 @@ class Cluster(object):
                                              spot_bid=spot_bid)
                     streaming_add(self, spots=resp,
                                   reboot_interval=reboot_interval,
-                                  n_reboot_restart=n_reboot_restart)
+                                  n_reboot_restart=n_reboot_restart,
+                                  max_configure_workers=self.configure_workers)
                 else:
                     # all nodes successfully created
                     break
@@ -1382,6 +1447,7 @@ class Cluster(object):
             if not terminate:
                 continue
             node.terminate()
+        self.invalidate_nodes()
 
     def _get_launch_map(self, reverse=False):
         """
@@ -1657,8 +1723,8 @@ class Cluster(object):
     @property
     def pool(self):
         if not self._pool:
-            self._pool = threadpool.get_thread_pool(
-                size=self.num_threads, disable_threads=self.disable_threads)
+            self._pool = threadpool.get_shared_pool(
+                disable_threads=self.disable_threads)
         return self._pool
 
     @property
@@ -1721,6 +1787,7 @@ class Cluster(object):
                         node.terminate()
                 else:
                     time.sleep(self.refresh_interval)
+                self.invalidate_nodes()
                 _nodes = self.get_nodes_or_raise(nodes)
         pbar.reset()
 
@@ -1827,6 +1894,7 @@ class Cluster(object):
         log.info("Rebooting cluster...")
         for node in nodes:
             node.reboot()
+        self.invalidate_nodes()
         if reboot_only:
             return
         sleep = 20
@@ -1868,6 +1936,7 @@ class Cluster(object):
         self.detach_volumes()
         for node in nodes:
             node.shutdown()
+        self.invalidate_nodes()
 
     def terminate_cluster(self, force=False):
         """
@@ -1886,6 +1955,7 @@ class Cluster(object):
         nodes = self.nodes
         for node in nodes:
             node.terminate()
+        self.invalidate_nodes()
         for spot in self.spot_requests:
             if spot.state not in ['cancelled', 'closed']:
                 log.info("Canceling spot instance request: %s" % spot.id)
@@ -1961,6 +2031,7 @@ class Cluster(object):
             for node in self.stopped_nodes:
                 log.info("Starting stopped node: %s" % node.alias)
                 node.start()
+            self.invalidate_nodes()
         if create_only:
             return
         self.setup_cluster(save_config_on_master)
@@ -2018,7 +2089,7 @@ class Cluster(object):
         name - a user-friendly label for the plugin
         method_name - the method to run within the plugin (default: "run")
         node - optional node to pass as first argument to plugin method (used
-        for on_add_node/on_remove_node)
+        for on_add_node/on_remove_node, list of nodes for on_add_nodes)
         """
         if args is None:
             args = []
@@ -2064,16 +2135,36 @@ class Cluster(object):
                           pseudo_tty=pseudo_tty,
                           command=command)
 
-    def get_impaired_nodes(self):
+    def broadcast(self, command, nodes=None, max_parallel=None, timeout=None,
+                  output_fn=None, ignore_exit_status=True):
+        """
+        Run command on all running nodes (or on nodes) at once and return a
+        BroadcastResult (exit status, output lines, elapsed time) per node.
+        See broadcast.broadcast for the kwargs.
+        """
+        if nodes is None:
+            nodes = self.running_nodes
+        return broadcast.broadcast(nodes, command, self.pool,
+                                   max_parallel=max_parallel, timeout=timeout,
+                                   output_fn=output_fn,
+                                   ignore_exit_status=ignore_exit_status)
+
+    def get_impaired_nodes(self, nodes=None):
+        """
+        Returns the impaired nodes among nodes (default: all cluster nodes)
+        using one instance status call per 100 nodes
+        """
+        nodes = nodes or self.nodes
         impaired_statuses = []
-        node_ids = [node.id for node in self.nodes]
+        node_ids = [node.id for node in nodes]
         for instance_id_batch in utils.chunk_list(node_ids, 100):
             impaired_statuses.extend(self.ec2.conn.get_all_instance_status(
                 instance_ids=instance_id_batch,
                 filters={"instance-status.status": "impaired"}
             ))
-        impaired_nodes_ids = [impaired.id for impaired in impaired_statuses]
-        return [node for node in self.nodes if node.id in impaired_nodes_ids]
+        impaired_nodes_ids = set([impaired.id
+                                  for impaired in impaired_statuses])
+        return [node for node in nodes if node.id in impaired_nodes_ids]
 
     def clean_impaired(self):
         impaired_nodes = self.get_impaired_nodes()
@@ -2113,6 +2204,7 @@ class Cluster(object):
                     continue
 
                 data['node'].handle_irresponsive_node()
+                self.invalidate_nodes()
 
     def clean(self):
         self.clean_impaired()
@@ -2153,7 +2245,7 @@ class Cluster(object):
                     node.rename(new_alias)
                     # force a memory refresh
                     self._nodes = []
-                    self.nodes
+                    self.invalidate_nodes()
 
     def recover(self, reboot_interval=10, n_reboot_restart=False):
         """
@@ -2168,7 +2260,8 @@ class Cluster(object):
         sirs = filter(lambda sir: sir.state == "open", self.spot_requests)
         if sirs:
             streaming_add(self, spots=sirs, reboot_interval=reboot_interval,
-                          n_reboot_restart=n_reboot_restart)
+                          n_reboot_restart=n_reboot_restart,
+                          max_configure_workers=self.configure_workers)
 
         to_recover = []
         if not self.disable_queue:
@@ -2184,7 +2277,8 @@ class Cluster(object):
         elif len(to_recover) == 1 and len(to_recover[0]) > 0:
             streaming_add(self, instances=to_recover[0],
                           reboot_interval=reboot_interval,
-                          n_reboot_restart=n_reboot_restart)
+                          n_reboot_restart=n_reboot_restart,
+                          max_configure_workers=self.configure_workers)
         log.info("Out of recover procedure")
 
 
@@ -2256,6 +2350,7 @@ class ClusterValidator(validators.Validator):
             self.validate_dns_suffix()
             self.validate_spot_bid()
             self.validate_cluster_size()
+            self.validate_configure_workers()
             self.validate_cluster_user()
             self.validate_shell_setting()
             self.validate_permission_settings()
@@ -2356,6 +2451,13 @@ class ClusterValidator(validators.Validator):
                 "must be <= cluster_size-1 (%s)" % (num_itypes, num_nodes))
         return True
 
+    def validate_configure_workers(self):
+        configure_workers = self.cluster.configure_workers
+        if not isinstance(configure_workers, int) or configure_workers < 1:
+            raise exception.ClusterValidationError(
+                'configure_workers must be an integer >= 1')
+        return True
+
     def validate_cluster_user(self):
         if self.cluster.cluster_user == "root":
             raise exception.ClusterValidationError(
@@ -45,6 +45,18 @@ class ClusterSetup(object):
         """
         raise NotImplementedError('on_add_node method not implemented')
 
+    def on_add_nodes(self, new_nodes, nodes, master, user, user_shell,
+                     volumes):
+        """
+        This method gets executed after a batch of nodes has been added to the
+        cluster
+
+        Plugins that can configure several new nodes at once should override
+        it. The default implementation calls on_add_node for each new node.
+        """
+        for node in new_nodes:
+            self.on_add_node(node, nodes, master, user, user_shell, volumes)
+
     def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
         """
         This method gets executed before a node is about to be removed from the
@@ -90,21 +102,24 @@ class DefaultClusterSetup(ClusterSetup):
     """
     Default ClusterSetup implementation for StarCluster
     """
-    def __init__(self, disable_threads=False, num_threads=20):
+    def __init__(self, disable_threads=False, num_threads=None,
+                 hosts_mode='etc_hosts'):
         self._nodes = None
         self._master = None
         self._user = None
         self._user_shell = None
         self._volumes = None
         self._disable_threads = disable_threads
-        self._num_threads = num_threads
+        self._hosts_mode = hosts_mode
         self._pool = None
+        if num_threads is not None:
+            threadpool.configure_num_threads(num_threads)
 
     @property
     def pool(self):
         if not self._pool:
-            self._pool = threadpool.get_thread_pool(self._num_threads,
-                                                    self._disable_threads)
+            self._pool = threadpool.get_shared_pool(
+                disable_threads=self._disable_threads)
         return self._pool
 
     @property
@@ -245,16 +260,64 @@ class DefaultClusterSetup(ClusterSetup):
                                  jobid=node.alias)
         self.pool.wait(numtasks=len(nodes))
 
-    def _setup_etc_hosts(self, nodes=None):
-        """ Configure /etc/hosts on all StarCluster nodes"""
+    def _setup_etc_hosts(self, nodes=None, new_nodes=None):
+        """
+        Configure /etc/hosts on all StarCluster nodes
+
+        If new_nodes is specified only the new nodes get the full hosts table
+        while the entries of the new nodes are appended to the /etc/hosts
+        file of the other nodes
+        """
         log.info("Configuring /etc/hosts on each node")
         nodes = nodes or self._nodes
         log.debug("Launching jobs " + str(datetime.datetime.utcnow()))
-        for node in nodes:
+        if new_nodes is None:
+            new_nodes = nodes
+        new_ids = set([node.id for node in new_nodes])
+        existing_nodes = [node for node in nodes if node.id not in new_ids]
+        for node in new_nodes:
             self.pool.simple_job(node.add_to_etc_hosts, (nodes, ),
                                  jobid=node.alias)
+        for node in existing_nodes:
+            self.pool.simple_job(node.append_to_etc_hosts, (new_nodes, ),
+                                 jobid=node.alias)
         self.pool.wait(numtasks=len(nodes))
 
+    def _setup_dnsmasq(self, nodes=None, new_nodes=None):
+        """
+        Configure the master to serve its /etc/hosts with dnsmasq and the
+        other nodes to use the master as their nameserver
+
+        If new_nodes is specified the entries of the new nodes are appended
+        to the master's /etc/hosts and only the new nodes are configured
+        """
+        log.info("Configuring dnsmasq on the master for name resolution")
+        nodes = nodes or self._nodes
+        master = self._master
+        if new_nodes is None:
+            master.add_to_etc_hosts(nodes)
+            master.start_dnsmasq()
+            new_nodes = nodes
+        else:
+            master.append_to_etc_hosts(new_nodes)
+            master.reload_dnsmasq()
+        new_nodes = [node for node in new_nodes if node.id != master.id]
+        for node in new_nodes:
+            self.pool.simple_job(node.set_nameserver,
+                                 (master.private_ip_address, ),
+                                 jobid=node.alias)
+        self.pool.wait(numtasks=len(new_nodes))
+
+    def _setup_hosts(self, nodes=None, new_nodes=None):
+        """
+        Configure name resolution of the node aliases according to the
+        hosts_mode setting
+        """
+        if self._hosts_mode == 'dnsmasq':
+            self._setup_dnsmasq(nodes, new_nodes=new_nodes)
+        else:
+            self._setup_etc_hosts(nodes, new_nodes=new_nodes)
+
     def _setup_passwordless_ssh(self, nodes=None):
         """
         Properly configure passwordless ssh for root and CLUSTER_USER on all
@@ -382,7 +445,7 @@ class DefaultClusterSetup(ClusterSetup):
         self._setup_ebs_volumes()
         self._setup_cluster_user()
         self._setup_scratch()
-        self._setup_etc_hosts()
+        self._setup_hosts()
         self._setup_nfs()
         self._setup_passwordless_ssh()
 
@@ -395,7 +458,10 @@ class DefaultClusterSetup(ClusterSetup):
                 master = n
 
         master.remove_from_etc_hosts([node])
-        master.copy_remote_file_to_nodes('/etc/hosts', nodes)
+        if self._hosts_mode == 'dnsmasq':
+            master.reload_dnsmasq()
+        else:
+            master.copy_remote_file_to_nodes('/etc/hosts', nodes)
 
     def _remove_nfs_exports(self, node):
         self._master.stop_exporting_fs_to_nodes([node])
@@ -436,22 +502,43 @@ class DefaultClusterSetup(ClusterSetup):
         self._remove_nfs_exports(node)
 
     def _create_user(self, node):
+        self._create_users([node])
+
+    def _create_users(self, nodes):
         user = self._master.getpwnam(self._user)
         uid, gid = user.pw_uid, user.pw_gid
-        self._add_user_to_nodes(uid, gid, nodes=[node])
+        self._add_user_to_nodes(uid, gid, nodes=nodes)
 
     def on_add_node(self, node, nodes, master, user, user_shell, volumes):
+        self._add_nodes([node], nodes, master, user, user_shell, volumes)
+
+    def on_add_nodes(self, new_nodes, nodes, master, user, user_shell,
+                     volumes):
+        """
+        Configures the new nodes as a batch unless a subclass overrides
+        on_add_node in which case it is called for each new node
+        """
+        on_add_node = self.on_add_node.im_func
+        if on_add_node is not DefaultClusterSetup.on_add_node.im_func:
+            ClusterSetup.on_add_nodes(self, new_nodes, nodes, master, user,
+                                      user_shell, volumes)
+        else:
+            self._add_nodes(new_nodes, nodes, master, user, user_shell,
+                            volumes)
+
+    def _add_nodes(self, new_nodes, nodes, master, user, user_shell,
+                   volumes):
         self._nodes = nodes
         self._master = master
         self._user = user
         self._user_shell = user_shell
         self._volumes = volumes
-        self._setup_hostnames(nodes=[node])
-        self._setup_etc_hosts(nodes)
-        self._setup_nfs(nodes=[node], start_server=False)
-        self._create_user(node)
-        self._setup_scratch(nodes=[node])
-        self._setup_passwordless_ssh(nodes=[node])
+        self._setup_hostnames(nodes=new_nodes)
+        self._setup_hosts(nodes, new_nodes=new_nodes)
+        self._setup_nfs(nodes=new_nodes, start_server=False)
+        self._create_users(new_nodes)
+        self._setup_scratch(nodes=new_nodes)
+        self._setup_passwordless_ssh(nodes=new_nodes)
 
     def clean_cluster(self, nodes, master, user, user_shell, volumes):
         pass
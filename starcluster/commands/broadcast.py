@@ -0,0 +1,89 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+
+from starcluster import broadcast
+from completers import ClusterCompleter
+
+
+class CmdBroadcast(ClusterCompleter):
+    """
+    broadcast [options] <cluster> <remote-command>
+
+    Run a command on all nodes of a cluster at once
+
+    Examples:
+
+        $ starcluster broadcast mycluster 'uptime'
+
+        # Only on some nodes, at most 10 at a time, killed after 60s
+        $ starcluster broadcast -n node001,node002 -p 10 -t 60 mycluster 'df'
+
+    The output of each node is displayed as it is received, prefixed by the
+    node's alias, followed by a summary where nodes with identical output and
+    exit status are grouped together. The exit code is 0 if the command
+    succeeded on all nodes, 1 otherwise.
+    """
+    names = ['broadcast', 'bc']
+
+    def addopts(self, parser):
+        parser.add_option("-n", "--nodes", dest="nodes", action="store",
+                          type="string", default=None,
+                          help="comma-separated list of nodes to run the "
+                          "command on (defaults to all running nodes)")
+        parser.add_option("-p", "--max-parallel", dest="max_parallel",
+                          action="store", type="int", default=None,
+                          help="run the command on at most MAX_PARALLEL "
+                          "nodes at a time")
+        parser.add_option("-t", "--timeout", dest="timeout", action="store",
+                          type="int", default=None,
+                          help="kill the command after TIMEOUT seconds")
+        parser.add_option("-q", "--quiet", dest="quiet", action="store_true",
+                          default=False,
+                          help="only display the grouped summary")
+
+    def _print_line(self, node, line):
+        print "%s: %s" % (node.alias, line)
+
+    def execute(self, args):
+        if len(args) < 2:
+            self.parser.error("please specify a cluster and a command")
+        cl = self.cm.get_cluster(args[0], load_receipt=False)
+        cmd = ' '.join(args[1:])
+        nodes = None
+        if self.opts.nodes:
+            nodes = cl.get_nodes(self.opts.nodes.split(','))
+        output_fn = None if self.opts.quiet else self._print_line
+        results = cl.broadcast(cmd, nodes=nodes,
+                               max_parallel=self.opts.max_parallel,
+                               timeout=self.opts.timeout, output_fn=output_fn)
+        groups = broadcast.group_broadcast_results(results)
+        for exit_status, output, group in groups:
+            aliases = ', '.join([r.node.alias for r in group])
+            elapsed = max([r.elapsed for r in group])
+            if group[0].error:
+                status = 'error: %s' % group[0].error
+            else:
+                status = 'exit status %d' % exit_status
+            print
+            print "---- %s (%d node(s), %s, %.1fs max)" % (
+                aliases, len(group), status, elapsed)
+            for line in output:
+                print line
+        if [r for r in results if not r.ok]:
+            sys.exit(1)
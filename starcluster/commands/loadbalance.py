@@ -127,6 +127,12 @@ class CmdLoadBalance(ClusterCompleter):
             "--spot-bid", dest="spot_bid", default=None,
             help="If set, forces spot instances to be used and overrides "
                  "the maximum price placed.")
+        parser.add_option(
+            "--clock-sync-interval", dest="clock_sync_interval",
+            action="callback", type="int", default=None,
+            callback=self._positive_int,
+            help="Seconds between measurements of the master's clock "
+            "offset (default: 600)")
 
     def execute(self, args):
         if not self.cfg.globals.enable_experimental:
@@ -16,7 +16,9 @@
 # along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
 
 import re
+import json
 import time
+import pipes
 import stat
 import base64
 import socket
@@ -25,11 +27,13 @@ import subprocess
 import datetime
 import tempfile
 import os
+import shutil
 
 import config
 from starcluster import utils
 from starcluster import static
 from starcluster import sshutils
+from starcluster import threadpool
 from starcluster import awsutils
 from starcluster import managers
 from starcluster import userdata
@@ -97,9 +101,10 @@ class Node(object):
         self._alias = alias
         self._groups = None
         self._ssh = None
-        self._num_procs = None
-        self._memory = None
+        self._facts = None
         self._user_data = None
+        self._passwd = None
+        self._group = None
 
     def __repr__(self):
         return '<Node: %s (%s)>' % (self.alias, self.id)
@@ -271,19 +276,71 @@ class Node(object):
 
     @property
     def num_processors(self):
-        if not self._num_procs:
-            self._num_procs = int(
-                self.ssh.execute(
-                    'cat /proc/cpuinfo | grep processor | wc -l')[0])
-        return self._num_procs
+        return self.facts['num_processors']
 
     @property
     def memory(self):
-        if not self._memory:
-            self._memory = float(
-                self.ssh.execute(
-                    "free -m | grep -i mem | awk '{print $2}'")[0])
-        return self._memory
+        return self.facts['memory']
+
+    @property
+    def facts(self):
+        """
+        Returns a dictionary of facts about the node's system: the number of
+        processors, the memory in MB, the machine's architecture, the distro,
+        the package provider (apt/yum) and the time zone.
+
+        The facts are gathered with a single remote command the first time
+        and saved in the instance's tags so that later runs reuse them
+        without connecting to the node (until the instance type changes).
+        """
+        if self._facts is None:
+            facts = self._load_facts_from_tags()
+            if facts is None:
+                facts = self.refresh_facts()
+            self._facts = facts
+        return self._facts
+
+    def _load_facts_from_tags(self):
+        raw = self.tags.get(static.FACTS_TAG)
+        if not raw:
+            return
+        try:
+            facts = json.loads(raw)
+        except ValueError:
+            log.debug("ignoring invalid facts tag on %s" % self.alias)
+            return
+        if facts.get('instance_type') != self.instance_type:
+            return
+        return facts
+
+    def refresh_facts(self):
+        """
+        Gathers the node's facts again (see facts) and saves them in the
+        instance's tags
+        """
+        output = self.ssh.execute(
+            "echo num_processors=$(grep -c ^processor /proc/cpuinfo); "
+            "echo memory=$(free -m | awk '/^Mem/ {print $2}'); "
+            "echo machine=$(uname -m); "
+            "echo distro=$(. /etc/os-release 2>/dev/null && "
+            "echo $ID $VERSION_ID); "
+            "echo package_provider=$(if [ -f /usr/bin/apt-get ]; then "
+            "echo apt; elif [ -f /usr/bin/yum ]; then echo yum; fi); "
+            "echo timezone=$(date +%Z)")
+        facts = dict(line.split('=', 1) for line in output if '=' in line)
+        facts['num_processors'] = int(facts['num_processors'])
+        facts['memory'] = float(facts['memory'])
+        facts['package_provider'] = facts.get('package_provider') or None
+        facts['instance_type'] = self.instance_type
+        self._facts = facts
+        try:
+            self.add_tag(static.FACTS_TAG,
+                         json.dumps(facts, separators=(',', ':'),
+                                    sort_keys=True))
+        except Exception, e:
+            log.debug("failed to save facts of %s in tags: %s" %
+                      (self.alias, e))
+        return facts
 
     @property
     def ip_address(self):
@@ -423,10 +480,50 @@ class Node(object):
         if user not in self.get_user_map():
             raise exception.BaseException("user %s does not exist" % user)
         if group in self.get_group_map():
-            self.ssh.execute('gpasswd -a %s %s' % (user, 'utmp'))
+            try:
+                self.ssh.execute('gpasswd -a %s %s' % (user, group))
+            finally:
+                self.invalidate_user_cache()
         else:
             raise exception.BaseException("group %s does not exist" % group)
 
+    def invalidate_user_cache(self):
+        """
+        Discard the cached contents of the remote /etc/passwd and /etc/group
+        files. add_user, remove_user and add_user_to_group do this already,
+        call it after modifying users or groups on the node by other means
+        (e.g. newusers).
+        """
+        self._passwd = None
+        self._group = None
+
+    def _get_group_entries(self):
+        if self._group is None:
+            grp_file = self.ssh.remote_file('/etc/group', 'r')
+            groups = [l.strip().split(':') for l in grp_file.readlines()]
+            grp_file.close()
+            entries = []
+            for group in groups:
+                name, passwd, gid, mems = group
+                entries.append(utils.struct_group([name, passwd, int(gid),
+                                                   mems.split(',')]))
+            self._group = entries
+        return self._group
+
+    def _get_passwd_entries(self):
+        if self._passwd is None:
+            etc_passwd = self.ssh.remote_file('/etc/passwd', 'r')
+            users = [l.strip().split(':') for l in etc_passwd.readlines()]
+            etc_passwd.close()
+            entries = []
+            for user in users:
+                name, passwd, uid, gid, gecos, home, shell = user
+                entries.append(utils.struct_passwd([name, passwd, int(uid),
+                                                    int(gid), gecos, home,
+                                                    shell]))
+            self._passwd = entries
+        return self._passwd
+
     def get_group_map(self, key_by_gid=False):
         """
         Returns dictionary where keys are remote group names and values are
@@ -434,19 +531,16 @@ class Node(object):
 
         key_by_gid=True will use the integer gid as the returned dictionary's
         keys instead of the group's name
+
+        /etc/group is only downloaded the first time and after the cache has
+        been invalidated (see invalidate_user_cache)
         """
-        grp_file = self.ssh.remote_file('/etc/group', 'r')
-        groups = [l.strip().split(':') for l in grp_file.readlines()]
-        grp_file.close()
         grp_map = {}
-        for group in groups:
-            name, passwd, gid, mems = group
-            gid = int(gid)
-            mems = mems.split(',')
-            key = name
+        for group in self._get_group_entries():
+            key = group.gr_name
             if key_by_gid:
-                key = gid
-            grp_map[key] = utils.struct_group([name, passwd, gid, mems])
+                key = group.gr_gid
+            grp_map[key] = group
         return grp_map
 
     def get_user_map(self, key_by_uid=False):
@@ -456,20 +550,16 @@ class Node(object):
 
         key_by_uid=True will use the integer uid as the returned dictionary's
         keys instead of the user's login name
+
+        /etc/passwd is only downloaded the first time and after the cache has
+        been invalidated (see invalidate_user_cache)
         """
-        etc_passwd = self.ssh.remote_file('/etc/passwd', 'r')
-        users = [l.strip().split(':') for l in etc_passwd.readlines()]
-        etc_passwd.close()
         user_map = {}
-        for user in users:
-            name, passwd, uid, gid, gecos, home, shell = user
-            uid = int(uid)
-            gid = int(gid)
-            key = name
+        for user in self._get_passwd_entries():
+            key = user.pw_name
             if key_by_uid:
-                key = uid
-            user_map[key] = utils.struct_passwd([name, passwd, uid, gid, gecos,
-                                                 home, shell])
+                key = user.pw_uid
+            user_map[key] = user
         return user_map
 
     def getgrgid(self, gid):
@@ -517,8 +607,6 @@ class Node(object):
         gid - optional group id to use when creating new user
         shell - optional shell assign to new user (default: bash)
         """
-        if gid:
-            self.ssh.execute('groupadd -o -g %s %s' % (gid, name))
         user_add_cmd = 'useradd -o '
         if uid:
             user_add_cmd += '-u %s ' % uid
@@ -527,7 +615,12 @@ class Node(object):
         if shell:
             user_add_cmd += '-s `which %s` ' % shell
         user_add_cmd += "-m %s" % name
-        self.ssh.execute(user_add_cmd)
+        try:
+            if gid:
+                self.ssh.execute('groupadd -o -g %s %s' % (gid, name))
+            self.ssh.execute(user_add_cmd)
+        finally:
+            self.invalidate_user_cache()
 
     def generate_key_for_user(self, username, ignore_existing=False,
                               auth_new_key=False, auth_conn_key=False):
@@ -656,51 +749,83 @@ class Node(object):
         self.add_to_known_hosts(username, nodes)
         # exclude this node from copying
         nodes = filter(lambda n: n.id != self.id, nodes)
-        # copy private key and public key to node
-        self.copy_remote_file_to_nodes(priv_key_file, nodes)
-        self.copy_remote_file_to_nodes(pub_key_file, nodes)
-        # copy authorized_keys and known_hosts to node
-        self.copy_remote_file_to_nodes(auth_key_file, nodes)
-        self.copy_remote_file_to_nodes(known_hosts_file, nodes)
+        # copy the keys, authorized_keys and known_hosts to each node
+        self.copy_remote_files_to_nodes([priv_key_file, pub_key_file,
+                                         auth_key_file, known_hosts_file],
+                                        nodes)
 
     def copy_remote_file_to_node(self, remote_file, node, dest=None):
         return self.copy_remote_file_to_nodes(remote_file, [node], dest=dest)
 
-    def copy_remote_file_to_nodes(self, remote_file, nodes, dest=None):
+    def copy_remote_file_to_nodes(self, remote_file, nodes, dest=None,
+                                  pool=None):
         """
         Copies a remote file from this Node instance to another Node instance
         without passwordless ssh between the two.
 
         dest - path to store the data in on the node (defaults to remote_file)
+        pool - ThreadPool used to upload to the nodes concurrently (defaults
+               to the shared pool)
         """
         if not dest:
             dest = remote_file
-        rf = self.ssh.remote_file(remote_file, 'r')
-        sts = rf.stat()
-        mode = stat.S_IMODE(sts.st_mode)
-        uid = sts.st_uid
-        gid = sts.st_gid
-        rf.close()
-        with tempfile.NamedTemporaryFile(
-                prefix=os.path.basename(remote_file) + "_") as f:
-            self.ssh.get(remote_file, f.name)
-            for node in nodes:
-                if self.id == node.id and remote_file == dest:
-                    log.warn("src and destination are the same: %s, skipping" %
-                             remote_file)
-                    continue
-                node.ssh.put(f.name, dest)
-                nrf = node.ssh.remote_file(dest, 'a')
-                nrf.chown(uid, gid)
-                nrf.chmod(mode)
-                nrf.close()
+        self.copy_remote_files_to_nodes([(remote_file, dest)], nodes,
+                                        pool=pool)
+
+    def copy_remote_files_to_nodes(self, remote_files, nodes, pool=None):
+        """
+        Copies remote files from this Node instance to each node in nodes
+        without passwordless ssh between them.
+
+        Each file is downloaded from this node once and then uploaded to all
+        nodes concurrently, one job per node copying every file, rather than
+        one node at a time.
+
+        remote_files - list of paths or (path, dest) tuples
+        pool - ThreadPool used to upload to the nodes concurrently (defaults
+               to the shared pool)
+        """
+        files = []
+        for rfile in remote_files:
+            if isinstance(rfile, basestring):
+                rfile = (rfile, rfile)
+            files.append(rfile)
+        tmpdir = tempfile.mkdtemp(prefix="starcluster-copy-")
+        try:
+            transfers = []
+            for i, (remote_file, dest) in enumerate(files):
+                sts = self.ssh.stat(remote_file)
+                local = os.path.join(tmpdir, "%d_%s" %
+                                     (i, os.path.basename(remote_file)))
+                self.ssh.get(remote_file, local)
+                transfers.append((local, dest, remote_file,
+                                  stat.S_IMODE(sts.st_mode), sts.st_uid,
+                                  sts.st_gid))
+            pool = pool or threadpool.get_shared_pool()
+            pool.map(lambda node: self._upload_files_to_node(node, transfers),
+                     nodes, jobid_fn=lambda node: node.alias)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _upload_files_to_node(self, node, transfers):
+        for local, dest, remote_file, mode, uid, gid in transfers:
+            if self.id == node.id and remote_file == dest:
+                log.warn("src and destination are the same: %s, skipping" %
+                         remote_file)
+                continue
+            node.ssh.put(local, dest)
+            node.ssh.sftp.chown(dest, uid, gid)
+            node.ssh.sftp.chmod(dest, mode)
 
     def remove_user(self, name):
         """
         Remove a user from the remote system
         """
-        self.ssh.execute('userdel %s' % name)
-        self.ssh.execute('groupdel %s' % name)
+        try:
+            self.ssh.execute('userdel %s' % name)
+            self.ssh.execute('groupdel %s' % name)
+        finally:
+            self.invalidate_user_cache()
 
     def export_fs_to_nodes(self, nodes, export_paths):
         """
@@ -752,9 +877,10 @@ class Node(object):
 
     def start_nfs_server(self):
         log.info("Starting NFS server on %s" % self.alias)
-        self.ssh.execute('/etc/init.d/portmap start', ignore_exit_status=True)
-        self.ssh.execute('mount -t rpc_pipefs sunrpc /var/lib/nfs/rpc_pipefs/',
-                         ignore_exit_status=True)
+        self.ssh.execute_many(
+            ['/etc/init.d/portmap start',
+             'mount -t rpc_pipefs sunrpc /var/lib/nfs/rpc_pipefs/'],
+            ignore_exit_status=True)
         EXPORTSD = '/etc/exports.d'
         DUMMY_EXPORT_DIR = '/dummy_export_for_broken_init_script'
         DUMMY_EXPORT_LINE = ' '.join([DUMMY_EXPORT_DIR,
@@ -762,13 +888,12 @@ class Node(object):
         DUMMY_EXPORT_FILE = posixpath.join(EXPORTSD, 'dummy.exports')
         # Hack to get around broken debian nfs-kernel-server script
         # http://bugs.debian.org/cgi-bin/bugreport.cgi?bug=679274
-        self.ssh.execute("mkdir -p %s" % EXPORTSD)
-        self.ssh.execute("mkdir -p %s" % DUMMY_EXPORT_DIR)
+        self.ssh.execute("mkdir -p %s %s" % (EXPORTSD, DUMMY_EXPORT_DIR))
         with self.ssh.remote_file(DUMMY_EXPORT_FILE, 'w') as dummyf:
             dummyf.write(DUMMY_EXPORT_LINE)
         self.ssh.execute('/etc/init.d/nfs start')
-        self.ssh.execute('rm -f %s' % DUMMY_EXPORT_FILE)
-        self.ssh.execute('rm -rf %s' % DUMMY_EXPORT_DIR)
+        self.ssh.execute_many(['rm -f %s' % DUMMY_EXPORT_FILE,
+                               'rm -rf %s' % DUMMY_EXPORT_DIR])
         self.ssh.execute('exportfs -fra')
 
     def mount_nfs_shares(self, server_node, remote_paths):
@@ -877,6 +1002,27 @@ class Node(object):
         with self.ssh.remote_file('/etc/hosts', 'w') as host_file:
             print >> host_file, "\n".join(host_file_lines)
 
+    def append_to_etc_hosts(self, nodes):
+        """
+        Appends the entries of the nodes in nodes arg to this node's
+        /etc/hosts file with a single remote command. Stale entries for the
+        same aliases or ips are removed first but, unlike add_to_etc_hosts,
+        the file is not downloaded and rewritten.
+        """
+        if not nodes:
+            return
+        exprs = []
+        for node in nodes:
+            ip = node.private_ip_address.replace('.', r'\.')
+            exprs.append('/^%s[[:space:]]/d' % ip)
+            exprs.append('/[[:space:]]%s([[:space:]]|$)/d' %
+                         node.short_alias)
+        entries = ' '.join([pipes.quote(node.get_hosts_entry())
+                            for node in nodes])
+        self.ssh.execute("sed -i -r %s /etc/hosts && "
+                         "printf '%%s\\n' %s >> /etc/hosts" %
+                         (pipes.quote(';'.join(exprs)), entries))
+
     @classmethod
     def filter_etc_hosts_lines(cls, nodes, lines):
         to_remove = \
@@ -910,6 +1056,46 @@ class Node(object):
             with self.ssh.remote_file('/etc/hosts', 'w') as host_file:
                 print >> host_file, "\n".join(lines)
 
+    def start_dnsmasq(self):
+        """
+        Serve the names in this node's /etc/hosts file to the other nodes
+        with dnsmasq (installed if missing)
+        """
+        if not self.ssh.isfile('/usr/sbin/dnsmasq'):
+            self.package_install('dnsmasq')
+        conf = self.ssh.remote_file('/etc/dnsmasq.d/starcluster', 'w')
+        listen = 'listen-address=127.0.0.1,%s' % self.private_ip_address
+        conf.write('\n'.join([listen,
+                              'bind-interfaces',
+                              'domain-needed',
+                              'no-negcache']) + '\n')
+        conf.close()
+        self.ssh.execute('service dnsmasq restart')
+
+    def reload_dnsmasq(self):
+        """
+        Make dnsmasq reread this node's /etc/hosts file
+        """
+        self.ssh.execute('pkill -HUP -x dnsmasq')
+
+    def set_nameserver(self, ip):
+        """
+        Resolve names with the nameserver at ip before the nameservers
+        provided by DHCP, now and after DHCP lease renewals
+        """
+        nameserver = 'nameserver %s\n' % ip
+        lines = self.ssh.get_remote_file_lines('/etc/resolv.conf')
+        lines = [line for line in lines if line != nameserver]
+        first = [i for i, line in enumerate(lines)
+                 if line.startswith('nameserver')]
+        lines.insert(first[0] if first else len(lines), nameserver)
+        self.ssh.write_to_remote_file('/etc/resolv.conf', lines)
+        prepend = 'prepend domain-name-servers %s;' % ip
+        dhclient_conf = '/etc/dhcp/dhclient.conf'
+        self.ssh.execute("grep -qxF %s %s || echo %s >> %s" %
+                         (pipes.quote(prepend), dhclient_conf,
+                          pipes.quote(prepend), dhclient_conf))
+
     def set_hostname(self, hostname=None):
         """
         Set this node's hostname to self.alias
@@ -1087,7 +1273,7 @@ class Node(object):
         """
         self.instance.reboot()
         if self._ssh:
-            self._ssh.close()
+            self._ssh.close(force=True)
             self._ssh = None
 
     def is_ssh_up(self):
@@ -1138,8 +1324,16 @@ class Node(object):
         while not self.is_up() and nrm.check():
             time.sleep(interval)
 
-    def is_up(self):
-        if self.update() != 'running':
+    def is_up(self, update=True):
+        """
+        Returns True if the instance is running and SSH is up.
+
+        update - refresh the instance's state from EC2 before checking. Pass
+        False when the state was just refreshed by a batched call (e.g.
+        Cluster.nodes) to avoid an extra DescribeInstances per node.
+        """
+        state = self.update() if update else self.state
+        if state != 'running':
             log.info(self.alias + " is not running")
             return False
         try:
@@ -1309,11 +1503,10 @@ class Node(object):
         In order to determine which packaging system to use, check to see if
         /usr/bin/apt exists on the node, and use apt if it exists. Otherwise
         test to see if /usr/bin/yum exists and use that.
+
+        The result is part of the node's facts (see facts)
         """
-        if self.ssh.isfile('/usr/bin/apt-get'):
-            return "apt"
-        elif self.ssh.isfile('/usr/bin/yum'):
-            return "yum"
+        return self.facts['package_provider']
 
     def package_install(self, pkgs):
         """
@@ -1360,16 +1553,21 @@ class NodeRecoveryManager(object):
         self._set_next_reboot()
         return True
 
-    def check(self):
+    def check(self, impaired=None):
         """
         Manages the reboot/restart/terminate (when spot) of a node.
         Returns True if the node is still alive, False otherwise.
+
+        impaired - the node's impaired status if already known (e.g. from a
+        batched instance status call). Queried from EC2 when None.
         """
         log.debug("{} next reboot {}"
                   .format(self.node.alias, self._next_reboot))
         log.debug("{} next restart {}"
                   .format(self.node.alias, self._next_restart))
-        if self.node.is_impaired():
+        if impaired is None:
+            impaired = self.node.is_impaired()
+        if impaired:
             log.info("{} is impaired".format(self.node.alias))
             rez = self.handle_reboot()
             log.debug("{} next restart {}"
@@ -123,7 +123,7 @@ class Hadoop(clustersetup.ClusterSetup):
     @property
     def pool(self):
         if self._pool is None:
-            self._pool = threadpool.get_thread_pool(20, disable_threads=False)
+            self._pool = threadpool.get_shared_pool()
         return self._pool
 
     def _get_java_home(self, node):
@@ -275,8 +275,9 @@ class Hadoop(clustersetup.ClusterSetup):
     def _setup_hadoop_dir(self, node, path, user, group, permission="775"):
         if not node.ssh.isdir(path):
             node.ssh.mkdir(path)
-        node.ssh.execute("chown -R %s:hadoop %s" % (user, path))
-        node.ssh.execute("chmod -R %s %s" % (permission, path))
+        # chown clears the setuid/setgid bits: chmod must run after it
+        node.ssh.execute("chown -R %s:hadoop %s && chmod -R %s %s" %
+                         (user, path, permission, path))
 
     def _start_datanode(self, node):
         node.ssh.execute('/etc/init.d/hadoop-0.20-datanode restart')
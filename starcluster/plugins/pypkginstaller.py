@@ -39,6 +39,7 @@ and the latest released version of some dependencies::
 
 """
 from starcluster.clustersetup import DefaultClusterSetup
+from starcluster.broadcast import broadcast
 from starcluster.logger import log
 from starcluster.utils import print_timing
 
@@ -58,9 +59,7 @@ class PyPkgInstaller(DefaultClusterSetup):
         for command in commands:
             log.info("$ " + command)
         cmd = "\n".join(commands)
-        for node in nodes:
-            self.pool.simple_job(node.ssh.execute, (cmd,), jobid=node.alias)
-        self.pool.wait(len(nodes))
+        broadcast(nodes, cmd, self.pool, ignore_exit_status=False)
 
     def run(self, nodes, master, user, user_shell, volumes):
         self.install_packages(nodes)
@@ -16,7 +16,9 @@
 # along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
 import posixpath
 import socket
+import threading
 
+from starcluster import utils
 from starcluster import clustersetup
 from starcluster.templates import sge
 from starcluster.logger import log
@@ -38,13 +40,28 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
     SGE_PROFILE = "/etc/profile.d/sge.sh"
     SGE_INST = "inst_sge_sc"
     SGE_CONF = "ec2_sge.conf"
+    # maximum number of hosts registered by a single qconf command line
+    QCONF_BATCH_SIZE = 100
+    # number of incremental updates of the parallel environment's slots
+    # after which the slots are recomputed from all nodes
+    PE_RECONCILE_INTERVAL = 50
+    # file on the master counting the incremental updates of a parallel
+    # environment since its slots were last recomputed
+    PE_UPDATES_FILE = "default/common/.pe_updates_%s"
 
     def __init__(self, master_is_exec_host=True, slots_per_host=None,
-                 **kwargs):
+                 install_wave_size=None, **kwargs):
         self.master_is_exec_host = str(master_is_exec_host).lower() == "true"
         self.slots_per_host = None
         if slots_per_host is not None:
             self.slots_per_host = int(slots_per_host)
+        self.install_wave_size = None
+        if install_wave_size is not None:
+            self.install_wave_size = int(install_wave_size)
+        # SGE arch of each AMI and the locks serializing its lookup
+        self._sge_arch = {}
+        self._sge_arch_locks = {}
+        self._sge_arch_lock = threading.Lock()
         super(SGEPlugin, self).__init__(**kwargs)
 
     def _add_sge_submit_host(self, node):
@@ -55,17 +72,75 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
         mssh = self._master.ssh
         mssh.execute('qconf -ah %s' % node.alias)
 
+    def _add_sge_admin_submit_hosts(self, nodes):
+        """
+        Add nodes as admin and submit hosts with a single command on the
+        master (per QCONF_BATCH_SIZE nodes)
+        """
+        for batch in utils.chunk_list(nodes, self.QCONF_BATCH_SIZE):
+            hosts = ','.join([node.alias for node in batch])
+            self._master.ssh.execute('qconf -ah %s && qconf -as %s' %
+                                     (hosts, hosts))
+
+    def _add_sge_exec_hosts(self, nodes):
+        """
+        Add installed exec hosts to the @allhosts hostgroup and set their
+        slots in all.q with a single command on the master (per
+        QCONF_BATCH_SIZE nodes)
+        """
+        for batch in utils.chunk_list(nodes, self.QCONF_BATCH_SIZE):
+            cmds = []
+            for node in batch:
+                cmds.append('qconf -aattr hostgroup hostlist %s @allhosts' %
+                            node.alias)
+                cmds.append('qconf -aattr queue slots "[%s=%d]" all.q' %
+                            (node.alias, self._get_num_slots(node)))
+            self._master.ssh.execute(' && '.join(cmds))
+
+    def _get_sge_arch(self, node):
+        """
+        Returns the SGE arch of node. util/arch only runs on the first node
+        of each AMI, the other nodes of the same AMI reuse its result.
+        """
+        arch = self._sge_arch.get(node.image_id)
+        if arch is None:
+            with self._sge_arch_lock:
+                lock = self._sge_arch_locks.setdefault(node.image_id,
+                                                       threading.Lock())
+            with lock:
+                arch = self._sge_arch.get(node.image_id)
+                if arch is None:
+                    arch = node.ssh.execute(self._sge_path("util/arch"))[0]
+                    self._sge_arch[node.image_id] = arch
+        return arch
+
     def _setup_sge_profile(self, node):
         sge_profile = node.ssh.remote_file(self.SGE_PROFILE, "w")
-        arch = node.ssh.execute(self._sge_path("util/arch"))[0]
+        arch = self._get_sge_arch(node)
         sge_profile.write(sge.sgeprofile_template % dict(arch=arch))
         sge_profile.close()
 
     def _add_to_sge(self, node):
-        node.ssh.execute('pkill -9 sge', ignore_exit_status=True)
-        node.ssh.execute('rm /etc/init.d/sge*', ignore_exit_status=True)
+        node.ssh.execute('pkill -9 sge; rm -f /etc/init.d/sge*',
+                         ignore_exit_status=True)
         self._inst_sge(node, exec_host=True)
 
+    def _add_nodes_to_sge(self, nodes):
+        """
+        Install SGE on exec hosts concurrently, in waves of at most
+        install_wave_size nodes (default: a single wave, as many nodes at a
+        time as the thread pool allows) to limit the load on the master's NFS
+        server
+        """
+        wave_size = self.install_wave_size or len(nodes)
+        for wave in utils.chunk_list(nodes, wave_size):
+            # only submit the next wave once this one completed so that no
+            # pool worker sits waiting for a wave slot
+            for node in wave:
+                self.pool.simple_job(self._add_to_sge, (node,),
+                                     jobid=node.alias)
+            self.pool.wait(numtasks=len(wave))
+
     def _create_sge_pe(self, name="smp", nodes=None, queue="all.q"):
         """
         Create or update an SGE parallel environment
@@ -81,24 +156,88 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
         log.info("%s SGE parallel environment '%s'" % (verb, name))
         if not nodes:
             nodes = self._nodes if self.master_is_exec_host else self.nodes
-        if self.slots_per_host is None:
-            pe_slots = sum(self.pool.map(lambda n: n.num_processors, nodes,
-                                         jobid_fn=lambda n: n.alias))
-        else:
-            pe_slots = self.slots_per_host * len(nodes)
+        pe_slots = sum(self.pool.map(self._get_num_slots, nodes,
+                                     jobid_fn=lambda n: n.alias))
+        # the incremental updates count restarts from 0
+        reset = "rm -f %s" % self._sge_path(self.PE_UPDATES_FILE % name)
         if not pe_exists:
             penv = mssh.remote_file("/tmp/pe.txt", "w")
             penv.write(sge.sge_pe_template % (name, pe_slots))
             penv.close()
-            mssh.execute("qconf -Ap %s" % penv.name)
+            mssh.execute("qconf -Ap %s && %s" % (penv.name, reset))
         else:
-            mssh.execute("qconf -mattr pe slots %s %s" % (pe_slots, name))
+            mssh.execute("qconf -mattr pe slots %s %s && %s" %
+                         (pe_slots, name, reset))
         if queue:
             log.info("Adding parallel environment '%s' to queue '%s'" %
                      (name, queue))
             mssh.execute('qconf -mattr queue pe_list "%s" %s' % (name, queue))
 
+    def _get_slots(self, command):
+        """
+        Returns the value of the slots attribute in the output of a qconf
+        command or None if the command failed or the value is not a number
+        """
+        mssh = self._master.ssh
+        output = mssh.execute(command, ignore_exit_status=True)
+        if mssh.get_last_status() != 0:
+            return
+        for line in output:
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == 'slots':
+                try:
+                    return int(fields[1])
+                except ValueError:
+                    return
+
+    def _update_sge_pe(self, nodes=None, added_slots=0, removed_slots=0,
+                       name="smp"):
+        """
+        Update the slots of an SGE parallel environment by the slots of the
+        added and removed hosts instead of recounting the slots of all nodes
+
+        Falls back to _create_sge_pe with nodes when the parallel environment
+        does not exist yet, when the slots of a removed host are unknown
+        (None) and every PE_RECONCILE_INTERVAL updates.
+        """
+        if self._count_pe_update(name) >= self.PE_RECONCILE_INTERVAL:
+            log.debug("Recounting slots of parallel environment '%s'" % name)
+            return self._create_sge_pe(name=name, nodes=nodes)
+        pe_slots = self._get_slots('qconf -sp %s' % name)
+        if pe_slots is None or removed_slots is None:
+            return self._create_sge_pe(name=name, nodes=nodes)
+        pe_slots = max(0, pe_slots + added_slots - removed_slots)
+        log.info("Updating SGE parallel environment '%s'" % name)
+        self._master.ssh.execute("qconf -mattr pe slots %s %s" %
+                                 (pe_slots, name))
+
+    def _count_pe_update(self, name):
+        """
+        Increments and returns the number of incremental updates of the
+        parallel environment since its slots were last recomputed. The count
+        is kept on the master so that it carries over from one addnode or
+        removenode run to the next.
+        """
+        path = self._sge_path(self.PE_UPDATES_FILE % name)
+        output = self._master.ssh.execute(
+            'n=$(($(cat %s 2>/dev/null || echo 0) + 1)) && echo $n > %s && '
+            'echo $n' % (path, path), ignore_exit_status=True)
+        try:
+            return int(output[-1])
+        except (IndexError, ValueError):
+            # unreadable count: recompute the slots
+            return self.PE_RECONCILE_INTERVAL
+
+    def _get_num_slots(self, node):
+        if self.slots_per_host is not None:
+            return self.slots_per_host
+        return node.num_processors
+
     def _inst_sge(self, node, exec_host=True):
+        """
+        Run the SGE install script on node. Exec hosts must then be added to
+        the queue with _add_sge_exec_hosts.
+        """
         self._setup_sge_profile(node)
         inst_sge = 'cd %s && TERM=rxvt ./%s ' % (self.SGE_ROOT, self.SGE_INST)
         if node.is_master():
@@ -107,14 +246,6 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
             inst_sge += '-x '
         inst_sge += '-noremote -auto ./%s' % self.SGE_CONF
         node.ssh.execute(inst_sge, silent=True, only_printable=True)
-        if exec_host:
-            num_slots = self.slots_per_host
-            if num_slots is None:
-                num_slots = node.num_processors
-            node.ssh.execute("qconf -aattr hostgroup hostlist %s @allhosts" %
-                             node.alias)
-            node.ssh.execute('qconf -aattr queue slots "[%s=%d]" all.q' %
-                             (node.alias, num_slots))
 
     def _sge_path(self, path):
         return posixpath.join(self.SGE_ROOT, path)
@@ -163,22 +294,24 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
         self._inst_sge(master, exec_host=self.master_is_exec_host)
         # set all.q shell to bash
         master.ssh.execute('qconf -mattr queue shell "/bin/bash" all.q')
-        for node in self.nodes:
-            self.pool.simple_job(self._add_to_sge, (node,), jobid=node.alias)
-        self.pool.wait(numtasks=len(self.nodes))
+        self._add_nodes_to_sge(self.nodes)
+        self._add_sge_exec_hosts(self._nodes if self.master_is_exec_host
+                                 else self.nodes)
         self._create_sge_pe()
 
     def _remove_from_sge(self, node, only_clean_master=False):
         master = self._master
-        master.ssh.execute('qconf -dattr hostgroup hostlist %s @allhosts' %
-                           node.alias)
-        master.ssh.execute('qconf -purge queue slots all.q@%s' % node.alias)
-        master.ssh.execute('qconf -dconf %s' % node.alias)
-        master.ssh.execute('qconf -de %s' % node.alias)
+        # slots of the host as configured in the queue by _add_sge_exec_hosts
+        slots = self._get_slots('qconf -sq all.q@%s' % node.alias)
+        master.ssh.execute(' && '.join([
+            'qconf -dattr hostgroup hostlist %s @allhosts' % node.alias,
+            'qconf -purge queue slots all.q@%s' % node.alias,
+            'qconf -dconf %s' % node.alias,
+            'qconf -de %s' % node.alias]))
         if not only_clean_master:
             node.ssh.execute('pkill -9 sge_execd', ignore_exit_status=True)
         nodes = filter(lambda n: n.alias != node.alias, self._nodes)
-        self._create_sge_pe(nodes=nodes)
+        self._update_sge_pe(nodes=nodes, removed_slots=slots)
 
     def get_nodes_to_recover(self, nodes):
         """
@@ -333,18 +466,24 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
         self._nodes = None
 
     def on_add_node(self, node, nodes, master, user, user_shell, volumes):
+        self.on_add_nodes([node], nodes, master, user, user_shell, volumes)
+
+    def on_add_nodes(self, new_nodes, nodes, master, user, user_shell,
+                     volumes):
         self._nodes = nodes
         self._master = master
         self._user = user
         self._user_shell = user_shell
         self._volumes = volumes
-        log.info("Adding %s to SGE" % node.alias)
-        self._setup_nfs(nodes=[node], export_paths=[self.SGE_ROOT],
+        log.info("Adding %s to SGE" % ', '.join([n.alias for n in new_nodes]))
+        self._setup_nfs(nodes=new_nodes, export_paths=[self.SGE_ROOT],
                         start_server=False)
-        self._add_sge_admin_host(node)
-        self._add_sge_submit_host(node)
-        self._add_to_sge(node)
-        self._create_sge_pe()
+        self._add_sge_admin_submit_hosts(new_nodes)
+        self._add_nodes_to_sge(new_nodes)
+        self._add_sge_exec_hosts(new_nodes)
+        added_slots = sum(self.pool.map(self._get_num_slots, new_nodes,
+                                        jobid_fn=lambda n: n.alias))
+        self._update_sge_pe(added_slots=added_slots)
 
         # fix to allow pickling
         self._nodes = None
@@ -352,9 +491,7 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
         self._user = None
         self._user_shell = None
         self._volumes = None
-        if self._pool:
-            self._pool.shutdown()
-            self._pool = None
+        self._pool = None
 
     def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
         self._nodes = nodes
@@ -372,6 +509,4 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
         self._user = None
         self._user_shell = None
         self._volumes = None
-        if self._pool:
-            self._pool.shutdown()
-            self._pool = None
+        self._pool = None
@@ -22,6 +22,7 @@ from starcluster import utils
 from starcluster import static
 from starcluster import exception
 from starcluster import clustersetup
+from starcluster.broadcast import broadcast
 from starcluster.logger import log
 
 
@@ -68,11 +69,12 @@ class CreateUsers(clustersetup.DefaultClusterSetup):
         log.info("Creating %d cluster users" % self._num_users)
         newusers = self._get_newusers_batch_file(master, self._usernames,
                                                  user_shell)
-        for node in nodes:
-            self.pool.simple_job(node.ssh.execute,
-                                 ("echo -n '%s' | newusers" % newusers),
-                                 jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
+        try:
+            broadcast(nodes, "echo -n '%s' | newusers" % newusers, self.pool,
+                      ignore_exit_status=False)
+        finally:
+            for node in nodes:
+                node.invalidate_user_cache()
         log.info("Configuring passwordless ssh for %d cluster users" %
                  self._num_users)
         pbar = self.pool.progress_bar.reset()
@@ -155,7 +157,10 @@ class CreateUsers(clustersetup.DefaultClusterSetup):
         log.info("Creating %d users on %s" % (self._num_users, node.alias))
         newusers = self._get_newusers_batch_file(master, self._usernames,
                                                  user_shell)
-        node.ssh.execute("echo -n '%s' | newusers" % newusers)
+        try:
+            node.ssh.execute("echo -n '%s' | newusers" % newusers)
+        finally:
+            node.invalidate_user_cache()
         log.info("Adding %s to known_hosts for %d users" %
                  (node.alias, self._num_users))
         pbar = self.pool.progress_bar.reset()
@@ -16,6 +16,7 @@
 # along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
 
 from starcluster import clustersetup
+from starcluster.broadcast import broadcast
 from starcluster.logger import log
 
 
@@ -44,10 +45,7 @@ class XvfbSetup(clustersetup.DefaultClusterSetup):
         self.pool.wait(numtasks=len(nodes))
 
     def _terminate(self, nodes):
-        for node in nodes:
-            self.pool.simple_job(node.ssh.execute, ('pkill Xvfb'),
-                                 jobid=node.alias)
-        self.pool.wait(numtasks=len(nodes))
+        broadcast(nodes, 'pkill Xvfb', self.pool, ignore_exit_status=False)
 
     def on_add_node(self, new_node, nodes, master, user, user_shell, volumes):
         log.info("Installing Xvfb on %s" % new_node.alias)
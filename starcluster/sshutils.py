@@ -20,14 +20,19 @@ import re
 import sys
 import stat
 import glob
+import time
 import atexit
 import string
 import socket
+import select
 import fnmatch
 import hashlib
+import weakref
 import warnings
 import posixpath
 import tempfile
+import threading
+import collections
 
 import scp
 import paramiko
@@ -43,10 +48,178 @@ except ImportError:
     HAS_TERMIOS = False
 
 from starcluster import exception
+from starcluster import threadpool
 from starcluster import progressbar
 from starcluster.logger import log
 
 
+class SSHConnectionPool(object):
+    """
+    Process-wide pool of authenticated SSH transports keyed by
+    (host, port, username) so that all SSHClient objects connecting to the
+    same host as the same user share one live transport instead of each
+    doing their own TCP + SSH handshake.
+
+    Transports are kept alive with SSH keepalives, checked before being
+    reused and closed once they have been unused for idle_timeout seconds.
+    A client that is garbage collected without having been closed gives its
+    transport back to the pool (see release_on_collect).
+    """
+    def __init__(self, keepalive=30, idle_timeout=300):
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        # key -> [transport, number of clients using it, last release time]
+        self._transports = {}
+        # weak references to the clients watched by release_on_collect
+        self._client_refs = set()
+        # sessions of garbage collected clients, released on next acquire
+        self._orphans = collections.deque()
+
+    def _get_key_lock(self, key):
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def _is_healthy(self, transport, idle_since):
+        if not transport.is_active():
+            return False
+        if idle_since and time.time() - idle_since > self.keepalive:
+            # idle for a while: make sure the peer is still there
+            try:
+                transport.send_ignore()
+            except Exception:
+                return False
+        return True
+
+    def _evict_idle(self):
+        now = time.time()
+        evicted = []
+        with self._lock:
+            for key, entry in self._transports.items():
+                transport, refs, idle_since = entry
+                if refs == 0 and now - idle_since > self.idle_timeout:
+                    evicted.append(transport)
+                    del self._transports[key]
+        for transport in evicted:
+            transport.close()
+
+    def release_on_collect(self, client, session):
+        """
+        Closes session (a _PooledSession) once client has been garbage
+        collected. The session is only queued by the weakref callback and
+        actually closed by the next acquire() since the garbage collector may
+        run while the collecting thread holds one of the pool's locks.
+        """
+        def collected(ref):
+            self._client_refs.discard(ref)
+            self._orphans.append(session)
+        self._client_refs.add(weakref.ref(client, collected))
+
+    def _close_orphans(self):
+        while True:
+            try:
+                session = self._orphans.popleft()
+            except IndexError:
+                return
+            session.close()
+
+    def acquire(self, key, connect_fn):
+        """
+        Returns a live transport for key, calling connect_fn() to create one
+        if none is available. Must be balanced with a call to release().
+        """
+        self._close_orphans()
+        self._evict_idle()
+        with self._get_key_lock(key):
+            with self._lock:
+                entry = self._transports.get(key)
+            if entry:
+                transport, refs, idle_since = entry
+                if self._is_healthy(transport, refs == 0 and idle_since):
+                    with self._lock:
+                        entry[1] += 1
+                    return transport
+                log.debug("discarding dead ssh transport to %s:%d (%s)" %
+                          key)
+                self.discard(key)
+            transport = connect_fn()
+            if self.keepalive:
+                transport.set_keepalive(self.keepalive)
+            with self._lock:
+                self._transports[key] = [transport, 1, None]
+            return transport
+
+    def release(self, key, transport):
+        """
+        Signals that a client is done with transport
+        """
+        with self._lock:
+            entry = self._transports.get(key)
+            if not entry or entry[0] is not transport:
+                # transport was discarded meanwhile
+                return
+            entry[1] = max(entry[1] - 1, 0)
+            if entry[1] == 0:
+                entry[2] = time.time()
+
+    def discard(self, key):
+        """
+        Closes and forgets the transport for key (e.g. the host rebooted)
+        """
+        with self._lock:
+            entry = self._transports.pop(key, None)
+        if entry:
+            entry[0].close()
+
+    def discard_host(self, host):
+        with self._lock:
+            keys = [k for k in self._transports if k[0] == host]
+        for key in keys:
+            self.discard(key)
+
+    def close_all(self):
+        self._close_orphans()
+        with self._lock:
+            keys = self._transports.keys()
+        for key in keys:
+            self.discard(key)
+
+
+connection_pool = SSHConnectionPool()
+atexit.register(connection_pool.close_all)
+
+
+class _PooledSession(object):
+    """
+    The transport an SSHClient got from the connection pool and the SFTP
+    session it opened on it. Kept out of the client so that they can be given
+    back once the client is garbage collected.
+    """
+    def __init__(self):
+        self.key = None
+        self.transport = None
+        self.sftp = None
+
+    def close(self, force=False):
+        if self.sftp:
+            try:
+                self.sftp.close()
+            except Exception:
+                log.debug("failed to close sftp session", exc_info=True)
+            self.sftp = None
+        if self.transport:
+            if force:
+                connection_pool.discard(self.key)
+            else:
+                connection_pool.release(self.key, self.transport)
+            self.transport = None
+            self.key = None
+
+
 class SSHClient(object):
     """
     Establishes an SSH connection to a remote host using either password or
@@ -54,6 +227,9 @@ class SSHClient(object):
     commands, copying files to/from the remote host, various file querying
     similar to os.path.*, and much more.
     """
+    STREAM_BUFSIZE = 32768
+    # lines of output kept by execute_stream for the error message
+    STREAM_TAIL_LINES = 100
 
     def __init__(self,
                  host,
@@ -70,9 +246,8 @@ class SSHClient(object):
         self._username = username or os.environ['LOGNAME']
         self._password = password
         self._timeout = timeout
-        self._sftp = None
+        self._session = _PooledSession()
         self._scp = None
-        self._transport = None
         self._progress_bar = None
         self._compress = compress
         if private_key:
@@ -81,7 +256,7 @@ class SSHClient(object):
             raise exception.SSHNoCredentialsError()
         self._glob = SSHGlob(self)
         self.__last_status = None
-        atexit.register(self.close)
+        connection_pool.release_on_collect(self, self._session)
 
     def load_private_key(self, private_key, private_key_pass=None):
         # Use Private Key.
@@ -110,6 +285,17 @@ class SSHClient(object):
         pkey = self._pkey
         if private_key:
             pkey = self.load_private_key(private_key, private_key_pass)
+        key = (host, port, username)
+        transport = connection_pool.acquire(
+            key, lambda: self._new_transport(host, port, username, password,
+                                             pkey, timeout, compress))
+        self.close()
+        self._session.key = key
+        self._session.transport = transport
+        return self
+
+    def _new_transport(self, host, port, username, password, pkey, timeout,
+                       compress):
         log.debug("connecting to host %s on port %d as user %s" % (host, port,
                                                                    username))
         try:
@@ -134,34 +320,26 @@ class SSHClient(object):
             raise exception.SSHConnectionError(host, port)
         except Exception, e:
             raise exception.SSHError(str(e))
-        self.close()
-        self._transport = transport
-        try:
-            assert self.sftp is not None
-        except paramiko.SFTPError, e:
-            if 'Garbage packet received' in e:
-                log.debug("Garbage packet received", exc_info=True)
-                raise exception.SSHAccessDeniedViaAuthKeys(username)
-            raise
-        return self
+        return transport
 
     @property
     def transport(self):
         """
         This property attempts to return an active SSH transport
         """
-        if not self._transport or not self._transport.is_active():
+        transport = self._session.transport
+        if not transport or not transport.is_active():
             self.connect(self._host, self._username, self._password,
                          port=self._port, timeout=self._timeout,
                          compress=self._compress)
-        return self._transport
+        return self._session.transport
 
     def get_server_public_key(self):
         return self.transport.get_remote_server_key()
 
     def is_active(self):
-        if self._transport:
-            return self._transport.is_active()
+        if self._session.transport:
+            return self._session.transport.is_active()
         return False
 
     def _get_socket(self, hostname, port):
@@ -201,12 +379,24 @@ class SSHClient(object):
 
     @property
     def sftp(self):
-        """Establish the SFTP connection."""
-        if not self._sftp or self._sftp.sock.closed:
+        """
+        Establish the SFTP connection. The SFTP session is only opened on the
+        first file operation so that clients that only run commands do not
+        hold an extra channel on the (shared) transport.
+        """
+        session = self._session
+        if not session.sftp or session.sftp.sock.closed:
             log.debug("creating sftp connection")
-            self._sftp = paramiko.SFTPClient.from_transport(self.transport)
-            self._sftp.get_channel().settimeout(self._timeout)
-        return self._sftp
+            transport = self.transport
+            try:
+                session.sftp = paramiko.SFTPClient.from_transport(transport)
+            except paramiko.SFTPError, e:
+                if 'Garbage packet received' in e:
+                    log.debug("Garbage packet received", exc_info=True)
+                    raise exception.SSHAccessDeniedViaAuthKeys(self._username)
+                raise
+            session.sftp.get_channel().settimeout(self._timeout)
+        return session.sftp
 
     @property
     def scp(self):
@@ -504,42 +694,104 @@ class SSHClient(object):
         """
         Execute a remote command and return the exit status
         """
-        channel = self.transport.open_session()
-        channel.settimeout(self._timeout)
-        if source_profile:
-            command = "source /etc/profile && %s" % command
-        channel.exec_command(command)
-        self.__last_status = channel.recv_exit_status()
+        with threadpool.host_limit(self._host):
+            channel = self.transport.open_session()
+            channel.settimeout(self._timeout)
+            if source_profile:
+                command = "source /etc/profile && %s" % command
+            channel.exec_command(command)
+            self.__last_status = channel.recv_exit_status()
         return self.__last_status
 
+    def _iter_output(self, channel, only_printable=False):
+        """
+        Yields (is_stderr, line) for each line of the stdout/stderr output of
+        a ssh channel as soon as it arrives (non-interactive only)
+
+        Both streams are read as data becomes available so that a command
+        filling up one of them never blocks waiting for the other one to be
+        read.
+        """
+        streams = [(False, channel.recv_ready, channel.recv),
+                   (True, channel.recv_stderr_ready, channel.recv_stderr)]
+        partial = {False: '', True: ''}
+        while True:
+            received = False
+            for is_stderr, ready, recv in streams:
+                if not ready():
+                    continue
+                data = recv(self.STREAM_BUFSIZE)
+                if not data:
+                    continue
+                received = True
+                lines = (partial[is_stderr] + data).split('\n')
+                partial[is_stderr] = lines.pop()
+                for line in lines:
+                    yield is_stderr, self._clean_line(line, only_printable)
+            if received:
+                continue
+            # sshd can send the exit status before the last of the output:
+            # only EOF (or close) guarantees that all of it was received
+            if channel.eof_received or channel.closed:
+                if not (channel.recv_ready() or channel.recv_stderr_ready()):
+                    break
+                continue
+            select.select([channel], [], [], 1)
+        for is_stderr in (False, True):
+            if partial[is_stderr]:
+                yield is_stderr, self._clean_line(partial[is_stderr],
+                                                  only_printable)
+
+    def _clean_line(self, line, only_printable=False):
+        if only_printable:
+            line = ''.join(c for c in line if c in string.printable)
+        return line.strip()
+
     def _get_output(self, channel, silent=True, only_printable=False):
         """
         Returns the stdout/stderr output from a ssh channel as a list of
         strings (non-interactive only)
         """
-        # stdin = channel.makefile('wb', -1)
-        stdout = channel.makefile('rb', -1)
-        stderr = channel.makefile_stderr('rb', -1)
-        if silent:
-            output = stdout.readlines() + stderr.readlines()
-        else:
-            output = []
-            line = None
-            while line != '':
-                line = stdout.readline()
-                if only_printable:
-                    line = ''.join(c for c in line if c in string.printable)
-                if line != '':
-                    output.append(line)
-                    print line,
-            for line in stderr.readlines():
-                output.append(line)
-                print line,
-        if only_printable:
-            output = map(lambda line: ''.join(c for c in line if c in
-                                              string.printable), output)
-        output = map(lambda line: line.strip(), output)
-        return output
+        stdout = []
+        stderr = []
+        for is_stderr, line in self._iter_output(channel, only_printable):
+            if is_stderr:
+                stderr.append(line)
+            else:
+                stdout.append(line)
+            if not silent:
+                print line
+        return stdout + stderr
+
+    def execute_stream(self, command, only_printable=False,
+                       ignore_exit_status=False, log_output=True,
+                       source_profile=True, raise_on_failure=True):
+        """
+        Execute a remote command and yield its stdout/stderr output lines,
+        interleaved, as soon as they arrive instead of returning them once
+        the command completed. Only the last lines are kept in memory for the
+        error message.
+
+        The exit status is checked, as done by execute, after the last line
+        and is then available from get_last_status(). The kwargs are the same
+        as execute's.
+        """
+        tail = collections.deque(maxlen=self.STREAM_TAIL_LINES)
+        with threadpool.host_limit(self._host):
+            channel, command = self._exec_command(command, source_profile)
+            try:
+                for is_stderr, line in self._iter_output(channel,
+                                                         only_printable):
+                    tail.append(line)
+                    yield line
+                exit_status = channel.recv_exit_status()
+            finally:
+                channel.close()
+        self.__last_status = exit_status
+        self._check_exit_status(command, exit_status, list(tail),
+                                ignore_exit_status=ignore_exit_status,
+                                log_output=log_output,
+                                raise_on_failure=raise_on_failure)
 
     def execute(self, command, silent=True, only_printable=False,
                 ignore_exit_status=False, log_output=True, detach=False,
@@ -562,24 +814,106 @@ class SSHClient(object):
         raise_on_failure - raise exception.SSHError if command fails
         returns List of output lines
         """
+        with threadpool.host_limit(self._host):
+            if detach:
+                channel = self.transport.open_session()
+                channel.settimeout(self._timeout)
+                command = "nohup %s &" % command
+                if source_profile:
+                    command = "source /etc/profile && %s" % command
+                channel.exec_command(command)
+                channel.close()
+                self.__last_status = None
+                return
+            channel, command = self._exec_command(command, source_profile)
+            output = self._get_output(channel, silent=silent,
+                                      only_printable=only_printable)
+            exit_status = channel.recv_exit_status()
+        self.__last_status = exit_status
+        self._check_exit_status(command, exit_status, output,
+                                ignore_exit_status=ignore_exit_status,
+                                log_output=log_output,
+                                raise_on_failure=raise_on_failure)
+        return output
+
+    def execute_many(self, commands, silent=True, only_printable=False,
+                     ignore_exit_status=False, log_output=True,
+                     source_profile=True, raise_on_failure=True):
+        """
+        Execute several independent remote commands concurrently, each on its
+        own channel of this connection's transport, and wait for all of them.
+        At most max_host_channels channels (see
+        threadpool.configure_shared_pool) are open at once.
+
+        The commands must not depend on each other: they can run in any order.
+        The kwargs are the same as execute's. If some of the commands fail,
+        the first failure is raised once all the commands have completed.
+
+        returns List of (exit status, output lines) in the order of commands
+        """
+        limiter = threadpool.get_host_limiter()
+        channels = []
+        results = []
+        held = 0
+        try:
+            for cmd in commands:
+                # each open channel holds one of the host's slots: only wait
+                # for a free slot when this call holds none, otherwise wait
+                # for the oldest command to complete to free its slot
+                while not limiter.acquire(self._host, blocking=not held):
+                    channel, command = channels[len(results)]
+                    results.append(self._get_exit_status_and_output(
+                        channel, silent, only_printable))
+                    held -= 1
+                    limiter.release(self._host)
+                held += 1
+                channels.append(self._exec_command(cmd, source_profile))
+            for channel, command in channels[len(results):]:
+                results.append(self._get_exit_status_and_output(
+                    channel, silent, only_printable))
+                held -= 1
+                limiter.release(self._host)
+        finally:
+            for i in range(held):
+                limiter.release(self._host)
+        failure = None
+        for (channel, command), (exit_status, output) in zip(channels,
+                                                             results):
+            try:
+                self._check_exit_status(
+                    command, exit_status, output,
+                    ignore_exit_status=ignore_exit_status,
+                    log_output=log_output, raise_on_failure=raise_on_failure)
+            except exception.RemoteCommandFailed, e:
+                failure = failure or e
+        if results:
+            self.__last_status = results[-1][0]
+        if failure:
+            raise failure
+        return results
+
+    def _get_exit_status_and_output(self, channel, silent=True,
+                                    only_printable=False):
+        output = self._get_output(channel, silent=silent,
+                                  only_printable=only_printable)
+        return channel.recv_exit_status(), output
+
+    def _exec_command(self, command, source_profile=True):
+        """
+        Start command on a new channel and return the channel along with the
+        actual command executed
+        """
         channel = self.transport.open_session()
         channel.settimeout(self._timeout)
-        if detach:
-            command = "nohup %s &" % command
-            if source_profile:
-                command = "source /etc/profile && %s" % command
-            channel.exec_command(command)
-            channel.close()
-            self.__last_status = None
-            return
         if source_profile:
             command = "source /etc/profile && %s" % command
         log.debug("executing remote command: %s" % command)
         channel.exec_command(command)
-        output = self._get_output(channel, silent=silent,
-                                  only_printable=only_printable)
-        exit_status = channel.recv_exit_status()
-        self.__last_status = exit_status
+        return channel, command
+
+    def _check_exit_status(self, command, exit_status, output,
+                           ignore_exit_status=False, log_output=True,
+                           raise_on_failure=True):
         out_str = '\n'.join(output)
         if exit_status != 0:
             msg = "remote command '%s' failed with status %d"
@@ -601,7 +935,6 @@ class SSHClient(object):
                 log.debug("output of '%s':\n%s" % (command, out_str))
             else:
                 log.debug("output of '%s' has been hidden" % command)
-        return output
 
     def has_required(self, progs):
         """
@@ -638,12 +971,14 @@ class SSHClient(object):
             env[key] = val
         return env
 
-    def close(self):
-        """Closes the connection and cleans up."""
-        if self._sftp:
-            self._sftp.close()
-        if self._transport:
-            self._transport.close()
+    def close(self, force=False):
+        """
+        Closes the connection and cleans up. The underlying transport is given
+        back to the connection pool unless force is True (e.g. the host is
+        rebooting) in which case it is closed for all its users.
+        """
+        self._scp = None
+        self._session.close(force=force)
 
     def _invoke_shell(self, term='screen', cols=80, lines=24):
         chan = self.transport.open_session()
@@ -745,11 +1080,6 @@ class SSHClient(object):
             # user hit ^Z or F6
             pass
 
-    def __del__(self):
-        """Attempt to clean up if not explicitly closed."""
-        log.debug('__del__ called')
-        self.close()
-
 
 # for backwards compatibility
 Connection = SSHClient
@@ -94,6 +94,8 @@ VOLUME_GROUP = SECURITY_GROUP_PREFIX + VOLUME_GROUP_NAME
 VERSION_TAG = SECURITY_GROUP_PREFIX + 'version'
 CORE_TAG = SECURITY_GROUP_PREFIX + 'core'
 USER_TAG = SECURITY_GROUP_PREFIX + 'user'
+# Node instance tag keys
+FACTS_TAG = SECURITY_GROUP_PREFIX + 'facts'
 MAX_TAG_LEN = 255
 
 # Internal StarCluster userdata filenames
@@ -244,6 +246,11 @@ PROTOCOLS = ['tcp', 'udp', 'icmp']
 
 WORLD_CIDRIP = '0.0.0.0/0'
 
+# how nodes resolve the aliases of the other cluster nodes: either every node
+# gets all aliases in its /etc/hosts or nodes query a dnsmasq server running on
+# the master which serves the master's /etc/hosts
+HOSTS_MODES = ['etc_hosts', 'dnsmasq']
+
 DEFAULT_SSH_PORT = 22
 
 AVAILABLE_SHELLS = {
@@ -260,6 +267,8 @@ GLOBAL_SETTINGS = {
     'enable_experimental': (bool, False, False, None, None),
     'refresh_interval': (int, False, 30, None, None),
     'web_browser': (str, False, None, None, None),
+    'max_threads': (int, False, 20, None, None),
+    'max_host_channels': (int, False, None, None, None),
     'include': (list, False, [], None, None),
 }
 
@@ -336,7 +345,10 @@ CLUSTER_SETTINGS = {
     'dns_prefix': (bool, False, False, None, None),
     'dns_suffix': (bool, False, False, None, None),
     'subnet_ids': (list, False, [], None, None),
-    'impaired_threshold_sec': (int, False, 120, None, None)
+    'impaired_threshold_sec': (int, False, 120, None, None),
+    'nodes_cache_ttl': (int, False, 10, None, None),
+    'hosts_mode': (str, False, 'etc_hosts', HOSTS_MODES, None),
+    'configure_workers': (int, False, 1, None, None),
 }
 
 NODE_SETTINGS = {
@@ -15,14 +15,153 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
 
+import sys
 import time
+import Queue
+import threading
 from functools import partial
 from starcluster.logger import log
 from starcluster import utils
+from starcluster import threadpool
 from starcluster.node import Node
 from starcluster.node import NodeRecoveryManager
 
 
+class PipelineStage(object):
+    """
+    Base class for a StreamingNodeAdd stage.
+
+    Lists of items are pushed to the stage with put() by the previous stage
+    (or by a later stage sending items back) and handed over to the next stage
+    with forward(). Items that leave the pipeline (node added or dead) are
+    reported to the pipeline so that it knows when all nodes are done.
+    """
+    def __init__(self, pipeline, name, num_workers=1):
+        self.pipeline = pipeline
+        self.name = name
+        self.num_workers = num_workers
+        self.queue = Queue.Queue()
+        self._threads = []
+
+    def put(self, items):
+        if items:
+            self.queue.put(list(items))
+
+    def forward(self, items, stage):
+        stage.put(items)
+        return len(items)
+
+    def start(self):
+        for i in range(self.num_workers):
+            t = threading.Thread(target=self._run_worker,
+                                 name="%s-%d" % (self.name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        for t in self._threads:
+            self.queue.put(None)
+
+    def _run_worker(self):
+        try:
+            self.run()
+        except Exception:
+            self.pipeline.abort(sys.exc_info())
+
+    def run(self):
+        raise NotImplementedError()
+
+
+class PollingStage(PipelineStage):
+    """
+    Stage that processes all of its pending items at once with process_fn.
+
+    The stage wakes up as soon as an item arrives while it is idle and
+    otherwise reprocesses its pending items every interval seconds. process_fn
+    must return the list of items that are still pending and the number of
+    items it forwarded to another stage. Pending items that are neither
+    returned nor forwarded are considered done.
+    """
+    def __init__(self, pipeline, name, process_fn, interval):
+        super(PollingStage, self).__init__(pipeline, name)
+        self.process_fn = process_fn
+        self.interval = interval
+        self.pending = []
+        self._last_run = 0
+
+    def _wait_for_work(self):
+        while not self.pipeline.finished.is_set():
+            timeout = None
+            if self.pending:
+                timeout = self._last_run + self.interval - time.time()
+                if timeout <= 0:
+                    return True
+            try:
+                items = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                continue
+            if items is None:
+                return False
+            idle = not self.pending
+            self.pending.extend(items)
+            if idle:
+                # stage was idle, drain what's queued and go
+                self._drain()
+                return True
+        return False
+
+    def _drain(self):
+        while True:
+            try:
+                items = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            if items is not None:
+                self.pending.extend(items)
+
+    def run(self):
+        while self._wait_for_work():
+            self._drain()
+            num_pending = len(self.pending)
+            self.pending, forwarded = self.process_fn(self.pending)
+            self._last_run = time.time()
+            self.pipeline.items_done(num_pending - len(self.pending) -
+                                     forwarded)
+
+
+class WorkerStage(PipelineStage):
+    """
+    Stage with num_workers threads, each processing with process_fn the items
+    that arrived since it last became idle, as soon as they arrive. process_fn
+    must return the number of items it forwarded to another stage.
+    """
+    def __init__(self, pipeline, name, process_fn, num_workers=1):
+        super(WorkerStage, self).__init__(pipeline, name,
+                                          num_workers=num_workers)
+        self.process_fn = process_fn
+
+    def run(self):
+        while not self.pipeline.finished.is_set():
+            items = self.queue.get()
+            if items is None:
+                return
+            stop = False
+            while True:
+                try:
+                    more = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if more is None:
+                    stop = True
+                    break
+                items.extend(more)
+            forwarded = self.process_fn(items)
+            self.pipeline.items_done(len(items) - forwarded)
+            if stop:
+                return
+
+
 class StreamingNodeAdd(object):
 
     """
@@ -30,74 +169,135 @@ class StreamingNodeAdd(object):
 
     Rather than having to wait at each step, push the unpropagated spots
     or instances through an initialization phases pipeline. The result is that
-    as soon as a node is ready, it is added to the clusteri, cutting down
+    as soon as a node is ready, it is added to the cluster, cutting down
     the time waiting for other nodes to be up. This class is especially useful
     the more the nodes that are added at once.
+
+    The pipeline is made of concurrent stages connected by queues:
+
+    spots -> propagation -> boot (running + SSH) -> configure (plugins)
+
+    so that running the plugins on ready nodes never blocks spot tracking or
+    SSH probing of the other nodes. The configure stage runs the on_add_nodes
+    plugins once for all the nodes that became ready together and runs
+    max_configure_workers plugin runs in parallel (the cluster's
+    configure_workers setting; plugins must be re-entrant to use more than
+    one). The boot stage probes SSH through its own pool of
+    max_probe_threads threads so that the probes never wait behind the
+    plugins' jobs in the shared pool.
     """
 
+    max_probe_threads = 10
+
     def __init__(self, cluster, spots, instances, reboot_interval,
-                 n_reboot_restart):
+                 n_reboot_restart, max_configure_workers=1):
         assert bool(spots) != bool(instances), \
             "You must define either spots or instances"
         self.cluster = cluster
-        self.unpropagated_spots = spots
-        self.spots = []
-        self.unpropagated_instances = instances
-        self.instances = []
         self.reboot_interval = reboot_interval
         self.n_reboot_restart = n_reboot_restart
         self.instances_nrm = {}
-        self.ready_instances = []
+        self.propagated_spot_ids = set()
+        self.finished = threading.Event()
+        self._lock = threading.Lock()
+        self._remaining = len(spots) + len(instances)
+        self._exc_info = None
+        self._probe_pool = None
+        interval = cluster.refresh_interval
+        self.spot_stage = PollingStage(self, "spots", self.stream_spots,
+                                       interval)
+        self.propagation_stage = PollingStage(
+            self, "propagation", self.stream_unpropagated_instances, interval)
+        self.boot_stage = PollingStage(self, "boot", self.stream_instances,
+                                       interval)
+        self.configure_stage = WorkerStage(
+            self, "configure", self.stream_ready_instances,
+            num_workers=max_configure_workers)
+        self.stages = [self.spot_stage, self.propagation_stage,
+                       self.boot_stage, self.configure_stage]
+        self.spot_stage.put(spots)
+        self.propagation_stage.put(instances)
+
+    @property
+    def probe_pool(self):
+        if not self._probe_pool:
+            self._probe_pool = threadpool.get_thread_pool(
+                size=self.max_probe_threads,
+                disable_threads=self.cluster.disable_threads)
+        return self._probe_pool
 
-    def stream_unpropagated_spots(self):
-        if not self.unpropagated_spots:
+    def items_done(self, count):
+        """
+        Called by the stages when count items left the pipeline
+        """
+        if count <= 0:
             return
+        with self._lock:
+            self._remaining -= count
+            if self._remaining <= 0:
+                self.finished.set()
 
-        propagated_spot_ids, _ = self.cluster.ec2.check_for_propagation(
-            spot_ids=[s.id for s in self.unpropagated_spots])
-        self.unpropagated_spots = utils.filter_move(
-            lambda s: s.id not in propagated_spot_ids,
-            self.unpropagated_spots, self.spots)
-        if self.unpropagated_spots:
-            log.info("Still waiting for unpropagated spots:"
-                     + str(self.unpropagated_spots))
+    def abort(self, exc_info):
+        """
+        Called by a stage that failed: stops the pipeline and re-raises the
+        error in the thread that called run()
+        """
+        log.debug("Streaming node add stage failed", exc_info=exc_info)
+        with self._lock:
+            if self._exc_info is None:
+                self._exc_info = exc_info
+        self.finished.set()
 
-    def stream_spots(self):
-        if not self.spots:
-            return
+    def stream_spots(self, spots):
+        unpropagated = [s for s in spots
+                        if s.id not in self.propagated_spot_ids]
+        if unpropagated:
+            propagated_spot_ids, _ = self.cluster.ec2.check_for_propagation(
+                spot_ids=[s.id for s in unpropagated])
+            self.propagated_spot_ids.update(propagated_spot_ids)
+            unpropagated = [s for s in unpropagated
+                            if s.id not in self.propagated_spot_ids]
+        if unpropagated:
+            log.info("Still waiting for unpropagated spots:"
+                     + str(unpropagated))
+        propagated = [s for s in spots if s.id in self.propagated_spot_ids]
+        if not propagated:
+            return unpropagated, 0
 
+        forwarded = 0
         instance_ids = []
-        self.spots = self.cluster.get_spot_requests_or_raise(self.spots)
-        self.spots = utils.filter_move(
+        propagated = self.cluster.get_spot_requests_or_raise(propagated)
+        propagated = utils.filter_move(
             lambda s: s.state != 'active' or s.instance_id is None,
-            self.spots, instance_ids, lambda s: s.instance_id)
+            propagated, instance_ids, lambda s: s.instance_id)
         if instance_ids:
             log.info("Instance ids:" + str(instance_ids))
-            for instance_id in instance_ids:
-                self.unpropagated_instances.append(
-                    UnpropagatedInstance(instance_id))
-        if self.spots:
-            self.spots = \
-                self.cluster.ec2.cancel_stuck_spot_instance_request(self.spots)
-        if self.spots:
-            log.info("Still waiting for spots: " + str(self.spots))
-
-    def stream_unpropagated_instances(self):
-        if not self.unpropagated_instances:
-            return
+            forwarded = self.spot_stage.forward(
+                [UnpropagatedInstance(i_id) for i_id in instance_ids],
+                self.propagation_stage)
+        if propagated:
+            propagated = \
+                self.cluster.ec2.cancel_stuck_spot_instance_request(propagated)
+        if propagated:
+            log.info("Still waiting for spots: " + str(propagated))
+        return unpropagated + propagated, forwarded
 
+    def stream_unpropagated_instances(self, instances):
         _, propagated_instance_ids = self.cluster.ec2.check_for_propagation(
-            instance_ids=[s.id for s in self. unpropagated_instances])
-        self.unpropagated_instances = utils.filter_move(
-            lambda i: i.id not in propagated_instance_ids,
-            self.unpropagated_instances, self.instances)
-        if self.unpropagated_instances:
+            instance_ids=[i.id for i in instances])
+        propagated = []
+        unpropagated = utils.filter_move(
+            lambda i: i.id not in propagated_instance_ids, instances,
+            propagated)
+        forwarded = self.propagation_stage.forward(propagated,
+                                                   self.boot_stage)
+        if unpropagated:
             log.info("Still waiting for unpropagated instances: "
-                     + str(self.unpropagated_instances))
-        self.instances = self.cluster.get_nodes_or_raise(nodes=self.instances)
+                     + str(unpropagated))
+        return unpropagated, forwarded
 
-    def stream_update_nrm(self):
-        for instance in self.instances:
+    def stream_update_nrm(self, instances):
+        for instance in instances:
             if instance.id not in self.instances_nrm:
                 nrm_cls = partial(NodeRecoveryManager,
                                   reboot_interval=self.reboot_interval,
@@ -108,45 +308,73 @@ class StreamingNodeAdd(object):
                     nrm = nrm_cls(Node(instance, self.cluster.key_location))
                 self.instances_nrm[instance.id] = nrm
 
-    def stream_instances(self):
-        if not self.instances:
-            return
+    def stream_instances(self, instances):
+        # one DescribeInstances for all pending instances (shared snapshot)
+        self.cluster.invalidate_nodes()
+        instances = self.cluster.get_nodes_or_raise(nodes=instances)
+        self.stream_update_nrm(instances)
+        running = [i for i in instances if i.state == 'running']
+        # the boot stage has its own pool: the shared pool runs the jobs of
+        # the plugins configuring other nodes in the configure stage
+        is_up = self.probe_pool.map(
+            lambda i: (i.id, i.is_up(update=False)), running,
+            jobid_fn=lambda i: i.alias)
+        up_ids = set([i_id for i_id, up in is_up if up])
+        ready_instances = []
+        instances = utils.filter_move(
+            lambda i: i.id not in up_ids, instances, ready_instances)
+        forwarded = self.boot_stage.forward(ready_instances,
+                                            self.configure_stage)
+        instances = self.stream_manage_reboots(instances)
+        if instances:
+            log.info("Still waiting for instances: " + str(instances))
+        return instances, forwarded
 
-        ssh_up = self.cluster.pool.map(lambda i: i.is_up(), self.instances)
-        zip_instances = utils.filter_move(
-            lambda i: i[0].state != 'running' or not i[1],
-            zip(self.instances, ssh_up), self.ready_instances,
-            lambda i: i[0])
-        self.instances = [i[0] for i in zip_instances]
-        if self.instances:
-            log.info("Still waiting for instances: " + str(self.instances))
+    def stream_manage_reboots(self, instances):
+        if not instances:
+            return instances
 
-    def stream_manage_reboots(self):
         dead_instances = []
-        self.instances = \
-            utils.filter_move(lambda i: self.instances_nrm[i.id].check(),
-                              self.instances, dead_instances)
+        impaired = self.cluster.get_impaired_nodes(nodes=instances)
+        impaired_ids = set([i.id for i in impaired])
+        instances = utils.filter_move(
+            lambda i: self.instances_nrm[i.id].check(
+                impaired=i.id in impaired_ids),
+            instances, dead_instances)
         for instance in dead_instances:
             del self.instances_nrm[instance.id]
+        return instances
 
-    def stream_ready_instances(self):
-        for ready_instance in self.ready_instances:
-            log.info("Adding node: %s" % ready_instance.alias)
-            up_nodes = filter(lambda n: n.is_up(), self.cluster.nodes)
-            try:
-                self.cluster.run_plugins(method_name="on_add_node",
-                                         node=ready_instance, nodes=up_nodes)
-                # success
-                del self.instances_nrm[ready_instance.id]
-            except:
-                log.error("Failed to add node {}"
-                          .format(ready_instance.alias), exc_info=True)
-                if self.instances_nrm[ready_instance.id].handle_reboot():
-                    # back to not ready list
-                    self.instances.append(ready_instance)
-                else:
-                    # dead, delete
-                    del self.instances_nrm[ready_instance.id]
+    def stream_ready_instances(self, ready_instances):
+        log.info("Adding node(s): %s" %
+                 ', '.join([i.alias for i in ready_instances]))
+        up_nodes = filter(lambda n: n.is_up(update=False),
+                          self.cluster.nodes)
+        try:
+            self.cluster.run_plugins(method_name="on_add_nodes",
+                                     node=ready_instances, nodes=up_nodes)
+        except:
+            if len(ready_instances) == 1:
+                return self.stream_failed_instance(ready_instances[0])
+            # find out which node(s) failed
+            log.error("Failed to add nodes as a batch, adding them one by "
+                      "one", exc_info=True)
+            return sum([self.stream_ready_instances([i])
+                        for i in ready_instances])
+        # success
+        for ready_instance in ready_instances:
+            del self.instances_nrm[ready_instance.id]
+        return 0
+
+    def stream_failed_instance(self, instance):
+        log.error("Failed to add node {}".format(instance.alias),
+                  exc_info=True)
+        if self.instances_nrm[instance.id].handle_reboot():
+            # back to not ready list
+            return self.configure_stage.forward([instance], self.boot_stage)
+        # dead, delete
+        del self.instances_nrm[instance.id]
+        return 0
 
     def run(self):
         """
@@ -155,27 +383,23 @@ class StreamingNodeAdd(object):
         interval = self.cluster.refresh_interval
         log.info("Waiting for one of the new nodes to be up "
                  "(updating every {}s)".format(interval))
-
-        while True:
-            self.ready_instances = []
-            self.stream_unpropagated_spots()
-            self.stream_spots()
-            self.stream_unpropagated_instances()
-            self.stream_update_nrm()
-            self.stream_instances()
-            self.stream_manage_reboots()
-            self.stream_ready_instances()
-
-            if any([self.unpropagated_spots, self.spots,
-                    self.unpropagated_instances, self.instances]):
-                if self.ready_instances:
-                    # ready_instances means nodes were added, that took
-                    # time so we should loop again now
-                    continue
-                log.info("Sleeping for {} seconds".format(interval))
-                time.sleep(interval)
-            else:
-                break
+        if self._remaining <= 0:
+            return
+        for stage in self.stages:
+            stage.start()
+        try:
+            while not self.finished.is_set():
+                self.finished.wait(1)
+        finally:
+            self.finished.set()
+            for stage in self.stages:
+                stage.stop()
+            if self._probe_pool:
+                self._probe_pool.shutdown()
+                self._probe_pool = None
+        if self._exc_info:
+            exc_type, exc_value, exc_tb = self._exc_info
+            raise exc_type, exc_value, exc_tb
 
 
 class UnpropagatedInstance(object):
@@ -183,13 +407,17 @@ class UnpropagatedInstance(object):
     def __init__(self, id):
         self.id = id
 
+    def __repr__(self):
+        return '<UnpropagatedInstance: %s>' % self.id
+
 
 def streaming_add(cluster, spots=None, instances=None, reboot_interval=10,
-                  n_reboot_restart=False):
+                  n_reboot_restart=False, max_configure_workers=1):
     if spots is None:
         spots = []
     if instances is None:
         instances = []
     sna = StreamingNodeAdd(cluster, spots, instances, reboot_interval,
-                           n_reboot_restart)
+                           n_reboot_restart,
+                           max_configure_workers=max_configure_workers)
     sna.run()
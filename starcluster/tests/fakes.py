@@ -0,0 +1,167 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Fake instances, nodes and SSH clients shared by the unit tests
+"""
+
+import stat
+import StringIO
+
+from starcluster.node import Node
+
+
+class FooGroup(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FooConnection(object):
+    aws_access_key_id = 'foo'
+    aws_secret_access_key = 'bar'
+
+
+class FooInstance(object):
+    instance_type = 'm3.xlarge'
+
+    def __init__(self, id, alias, group, state='running'):
+        self.id = id
+        self.state = state
+        self.groups = [FooGroup(group)]
+        self.tags = {'alias': alias, 'Name': alias}
+        self.connection = FooConnection()
+        self.spot_instance_request_id = None
+        self.dns_name = '%s.compute.amazonaws.com' % id
+        self.public_dns_name = self.dns_name
+        self.private_dns_name = '%s.ec2.internal' % id
+        self.ip_address = None
+        self.private_ip_address = None
+
+    def add_tag(self, key, value=None):
+        self.tags[key] = value
+
+
+class FooStat(object):
+    st_mode = stat.S_IFREG | 0600
+    st_uid = 1000
+    st_gid = 1001
+
+
+class FooSFTP(object):
+    def __init__(self):
+        self.attrs = {}
+
+    def chown(self, path, uid, gid):
+        self.attrs.setdefault(path, {})['owner'] = (uid, gid)
+
+    def chmod(self, path, mode):
+        self.attrs.setdefault(path, {})['mode'] = mode
+
+
+class FooSSH(object):
+    """
+    Fake SSHClient: records the commands it runs in commands and answers each
+    of them with respond(ssh, command), which returns the output lines and
+    can set the exit status in ssh.status. Remote files are kept in the files
+    dict; downloads are counted in gets and remote_file reads in reads.
+    """
+    def __init__(self, respond=None, files=None):
+        self.respond = respond
+        self.files = files or {}
+        self.commands = []
+        self.status = 0
+        self.sftp = FooSFTP()
+        self.gets = 0
+        self.reads = 0
+
+    def execute(self, command, **kwargs):
+        self.commands.append(command)
+        self.status = 0
+        if self.respond:
+            return self.respond(self, command) or []
+        return []
+
+    def execute_stream(self, command, **kwargs):
+        for line in self.execute(command, **kwargs):
+            yield line
+
+    def get_status(self, command, **kwargs):
+        self.execute(command, **kwargs)
+        return self.status
+
+    def get_last_status(self):
+        return self.status
+
+    def remote_file(self, path, mode='r'):
+        self.reads += 1
+        return StringIO.StringIO(self.files[path])
+
+    def stat(self, path):
+        return FooStat()
+
+    def get(self, remote_path, local_path):
+        self.gets += 1
+        with open(local_path, 'w') as f:
+            f.write(self.files[remote_path])
+
+    def put(self, local_path, remote_path):
+        with open(local_path) as f:
+            self.files[remote_path] = f.read()
+
+    def close(self):
+        pass
+
+
+def output(lines, status=0):
+    """
+    Returns a FooSSH respond function answering every command with lines and
+    the exit status status
+    """
+    def respond(ssh, command):
+        ssh.status = status
+        return lines
+    return respond
+
+
+class FooRecordingNode(object):
+    """
+    Node that records the calls of its methods, with their arguments, in calls
+    instead of running them
+    """
+    def __init__(self, id, private_ip_address):
+        self.id = id
+        self.alias = id
+        self.private_ip_address = private_ip_address
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args: self.calls.append((name, ) + args)
+
+
+class FooNode(Node):
+    """
+    Node of a FooInstance whose SSH client is ssh (a FooSSH by default)
+    """
+    def __init__(self, alias, private_ip_address=None, ssh=None,
+                 instance=None):
+        if instance is None:
+            instance = FooInstance('i-%s' % alias, alias, '@sc-foo')
+            instance.private_ip_address = private_ip_address
+        Node.__init__(self, instance, None, alias=alias)
+        self._ssh = ssh or FooSSH()
@@ -15,6 +15,8 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
 
+import re
+
 qhost_xml = """<?xml version='1.0'?>
 <qhost xmlns:xsd="http://gridengine.sunsource.net/source/browse/*checkout*/\
 gridengine/source/dist/util/resources/schemas/qhost/qhost.xsd?revision=1.2">
@@ -3231,3 +3233,69 @@ all.q@domU-12-31-39-0B-C4-C1.compute-1.internal</queue_name>
     </job_list>
   </job_info>
 </job_info>"""
+
+
+def scale_qstat_xml(qstat_xml, factor):
+    """
+    Returns qstat_xml with each of its queued jobs repeated factor times and
+    its running jobs repeated factor times in each queue (used to benchmark
+    the parsers on large queues)
+    """
+    start = qstat_xml.index('<job_list')
+    end = qstat_xml.index('</Queue-List>')
+    running = qstat_xml[start:end]
+    pending_start = qstat_xml.index('<job_info>') + len('<job_info>')
+    # the pending jobs are in a job_info element nested in the root job_info
+    pending_end = qstat_xml.rindex('</job_info>', 0,
+                                   qstat_xml.rindex('</job_info>'))
+    pending = qstat_xml[pending_start:pending_end]
+    return ''.join([qstat_xml[:start], running * factor,
+                    qstat_xml[end:pending_start], pending * factor,
+                    qstat_xml[pending_end:]])
+
+
+def scale_qhost_xml(qhost_xml, factor):
+    """
+    Returns qhost_xml with each of its execution hosts repeated factor times,
+    the copies being renamed <name>-<copy number> (used to benchmark the
+    parsers on large clusters)
+    """
+    # the first host is 'global'
+    start = qhost_xml.index('<host name=', qhost_xml.index('</host>'))
+    end = qhost_xml.index('</qhost>')
+    hosts = qhost_xml[start:end]
+    copies = [hosts]
+    for i in range(1, factor):
+        copies.append(re.sub(r"<host name='([^']*)'",
+                             r"<host name='\1-%d'" % i, hosts))
+    return ''.join([qhost_xml[:start]] + copies + [qhost_xml[end:]])
+
+# the jobs 1-6 of qacct_txt as recorded in the accounting file, followed by a
+# job deleted before it started
+accounting_txt = """\
+# Version: 6.2u5
+#
+# DO NOT MODIFY THIS FILE MANUALLY!
+#
+all.q:domU-12-31-38-00-A6-41.compute-1.internal:root:root:sleep:2:sge:0:127921\
+7913:1279217921:1279217981:0:0:60:0.000:0.000:0:0:0:0:0:771:0:0:16:8:0:0:0:4:0\
+:NONE:defaultdepartment:NONE:1:0:0.000:0.000:0.000::0.000:NONE:3042967:0:0
+all.q:domU-12-31-38-00-A5-A1.compute-1.internal:root:root:sleep:1:sge:0:127921\
+7911:1279217921:1279217981:0:0:60:0.000:0.000:0:0:0:0:0:792:0:0:16:160:0:0:0:8\
+6:0:NONE:defaultdepartment:NONE:1:0:0.000:0.000:0.000::0.000:NONE:3042967:0:0
+all.q:domU-12-31-38-00-A6-41.compute-1.internal:root:root:sleep:4:sge:0:127921\
+7915:1279217996:1279218056:0:0:60:0.010:0.000:0:0:0:0:0:773:0:0:0:8:0:0:0:2:1:\
+NONE:defaultdepartment:NONE:1:0:0.010:0.000:0.000::0.000:NONE:0:0:0
+all.q:domU-12-31-38-00-A5-A1.compute-1.internal:root:root:sleep:3:sge:0:127921\
+7914:1279217996:1279218056:0:0:60:0.000:0.010:0:0:0:0:0:790:0:0:0:160:0:0:0:84\
+:0:NONE:defaultdepartment:NONE:1:0:0.010:0.000:0.000::0.000:NONE:3042967:0:0
+all.q:domU-12-31-38-00-A6-41.compute-1.internal:root:root:sleep:6:sge:0:127921\
+7918:1279218071:1279218131:0:0:60:0.010:0.000:0:0:0:0:0:773:0:0:0:8:0:0:0:2:1:\
+NONE:defaultdepartment:NONE:1:0:0.010:0.000:0.000::0.000:NONE:3042967:0:0
+all.q:domU-12-31-38-00-A5-A1.compute-1.internal:root:root:sleep:5:sge:0:127921\
+7916:1279218071:1279218131:0:0:60:0.000:0.000:0:0:0:0:0:792:0:0:0:160:0:0:0:84\
+:0:NONE:defaultdepartment:NONE:1:0:0.000:0.000:0.000::0.000:NONE:3042967:0:0
+all.q:domU-12-31-38-00-A5-A1.compute-1.internal:root:root:sleep:19:sge:0:12792\
+18860:0:0:19:0:0:0.000:0.000:0:0:0:0:0:0:0:0:0:0:0:0:0:0:0:NONE:defaultdepartm\
+ent:NONE:1:0:0.000:0.000:0.000::0.000:NONE:0:0:0
+"""
@@ -0,0 +1,48 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+logging.disable(logging.WARN)
+
+from starcluster import tests
+from starcluster import exception
+from starcluster import broadcast
+from starcluster import threadpool
+from starcluster.tests.fakes import FooSSH
+from starcluster.tests.fakes import FooNode
+from starcluster.tests.fakes import output
+
+
+class TestBroadcast(tests.StarClusterTest):
+
+    def test_broadcast(self):
+        nodes = [FooNode('master', ssh=FooSSH(output(['a']))),
+                 FooNode('node001', ssh=FooSSH(output(['b'], 1))),
+                 FooNode('node002', ssh=FooSSH(output(['a'])))]
+        pool = threadpool.get_thread_pool(3, disable_threads=True)
+        lines = []
+        results = broadcast.broadcast(
+            nodes, 'foo', pool, max_parallel=2,
+            output_fn=lambda n, l: lines.append((n.alias, l)))
+        assert [r.exit_status for r in results] == [0, 1, 0]
+        assert sorted(lines) == [('master', 'a'), ('node001', 'b'),
+                                 ('node002', 'a')]
+        groups = broadcast.group_broadcast_results(results)
+        assert [(s, o, [r.node.alias for r in g]) for s, o, g in groups] == \
+            [(0, ['a'], ['master', 'node002']), (1, ['b'], ['node001'])]
+        self.assertRaises(exception.RemoteCommandFailed, broadcast.broadcast,
+                          nodes, 'foo', pool, ignore_exit_status=False)
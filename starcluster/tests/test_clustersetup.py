@@ -0,0 +1,105 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+logging.disable(logging.WARN)
+
+from starcluster import tests
+from starcluster.clustersetup import ClusterSetup
+from starcluster.clustersetup import DefaultClusterSetup
+from starcluster.tests.fakes import FooRecordingNode
+
+
+class FooPlugin(ClusterSetup):
+    def __init__(self):
+        self.added = []
+
+    def on_add_node(self, node, nodes, master, user, user_shell, volumes):
+        self.added.append(node)
+
+
+class FooDefaultPlugin(DefaultClusterSetup):
+    def __init__(self):
+        DefaultClusterSetup.__init__(self, disable_threads=True)
+        self.added = []
+
+    def on_add_node(self, node, nodes, master, user, user_shell, volumes):
+        self.added.append(node)
+
+    def _add_nodes(self, *args):
+        raise AssertionError("DefaultClusterSetup configured the nodes")
+
+
+class TestClusterSetup(tests.StarClusterTest):
+
+    def test_on_add_nodes_default(self):
+        plugin = FooPlugin()
+        plugin.on_add_nodes(['node001', 'node002'], [], None, 'sgeadmin',
+                            'bash', {})
+        assert plugin.added == ['node001', 'node002']
+        # subclasses of DefaultClusterSetup that only define on_add_node
+        plugin = FooDefaultPlugin()
+        plugin.on_add_nodes(['node001', 'node002'], [], None, 'sgeadmin',
+                            'bash', {})
+        assert plugin.added == ['node001', 'node002']
+        # DefaultClusterSetup itself configures the new nodes as a batch
+        batches = []
+        plugin = DefaultClusterSetup(disable_threads=True)
+        plugin._add_nodes = lambda new_nodes, *args: batches.append(new_nodes)
+        plugin.on_add_nodes(['node001', 'node002'], [], None, 'sgeadmin',
+                            'bash', {})
+        assert batches == [['node001', 'node002']]
+
+    def test_etc_hosts_mode(self):
+        master = FooRecordingNode('master', '10.0.0.1')
+        nodes = [master] + [FooRecordingNode('node%.3d' % i,
+                                             '10.0.0.%d' % (i + 1))
+                            for i in range(1, 4)]
+        setup = DefaultClusterSetup(disable_threads=True)
+        setup._master = master
+        setup._setup_hosts(nodes)
+        for node in nodes:
+            assert node.calls == [('add_to_etc_hosts', nodes)]
+            node.calls = []
+        # existing nodes only get the entries of the new node appended
+        new = FooRecordingNode('node004', '10.0.0.5')
+        setup._setup_hosts(nodes + [new], new_nodes=[new])
+        assert new.calls == [('add_to_etc_hosts', nodes + [new])]
+        for node in nodes:
+            assert node.calls == [('append_to_etc_hosts', [new])]
+
+    def test_dnsmasq_hosts_mode(self):
+        master = FooRecordingNode('master', '10.0.0.1')
+        nodes = [FooRecordingNode('node%.3d' % i, '10.0.0.%d' % (i + 1))
+                 for i in range(1, 4)]
+        setup = DefaultClusterSetup(disable_threads=True,
+                                    hosts_mode='dnsmasq')
+        setup._master = master
+        setup._setup_hosts([master] + nodes)
+        assert master.calls == [('add_to_etc_hosts', [master] + nodes),
+                                ('start_dnsmasq', )]
+        for node in nodes:
+            assert node.calls == [('set_nameserver', '10.0.0.1')]
+        # adding a node only touches the master and the new node
+        master.calls = []
+        new = FooRecordingNode('node004', '10.0.0.5')
+        setup._setup_hosts([master] + nodes + [new], new_nodes=[new])
+        assert master.calls == [('append_to_etc_hosts', [new]),
+                                ('reload_dnsmasq', )]
+        assert new.calls == [('set_nameserver', '10.0.0.1')]
+        for node in nodes:
+            assert len(node.calls) == 1
@@ -19,18 +19,22 @@ import logging
 logging.disable(logging.WARN)
 
 from starcluster import tests
+from starcluster import exception
+from starcluster import threadpool
 from starcluster.node import Node
 from starcluster.cluster import Cluster
+from starcluster.tests.fakes import FooNode
+from starcluster.tests.fakes import FooInstance
 
 
-class FooNode(Node):
-    def __init__(self, alias, private_ip_address):
-        self._alias = alias
-        self._private_ip_address = private_ip_address
+class FooEC2(object):
+    def __init__(self, instances):
+        self.instances = instances
+        self.calls = 0
 
-    @property
-    def private_ip_address(self):
-        return self._private_ip_address
+    def get_all_instances(self, instance_ids=None, filters=None):
+        self.calls += 1
+        return self.instances[:]
 
 
 class TestStarClusterGeneric(tests.StarClusterTest):
@@ -71,3 +75,44 @@ class TestStarClusterGeneric(tests.StarClusterTest):
         res = Cluster.get_free_ids_among_nodes(5, [node001, node003, node005,
                                                    node006, node106])
         assert res == [2, 4, 7, 8, 9]
+
+    def _get_cluster(self, num_nodes=3, ttl=10):
+        cl = Cluster(cluster_tag='foo', nodes_cache_ttl=ttl)
+        group = cl._security_group
+        aliases = ['master'] + ['node%03d' % i for i in range(1, num_nodes)]
+        instances = [FooInstance('i-%d' % i, alias, group)
+                     for i, alias in enumerate(aliases)]
+        cl.ec2 = FooEC2(instances)
+        return cl
+
+    def test_nodes_snapshot(self):
+        cl = self._get_cluster()
+        assert len(cl.nodes) == 3
+        assert cl.master_node.alias == 'master'
+        cl.running_nodes
+        cl.get_nodes_or_raise()
+        assert cl.ec2.calls == 1
+        cl.ec2.instances.pop()
+        assert len(cl.nodes) == 3
+        cl.invalidate_nodes()
+        assert len(cl.nodes) == 2
+        assert cl.ec2.calls == 2
+
+    def test_nodes_snapshot_disabled(self):
+        cl = self._get_cluster(ttl=0)
+        cl.nodes
+        cl.nodes
+        assert cl.ec2.calls == 2
+
+    def test_get_node_index(self):
+        cl = self._get_cluster()
+        node = cl.get_node('node001')
+        assert node.id == 'i-1'
+        assert cl.get_node('i-2').alias == 'node002'
+        assert cl.get_node('i-2.ec2.internal').alias == 'node002'
+        nodes = cl.get_nodes(['node002', 'i-2', 'master'])
+        assert [n.alias for n in nodes] == ['node002', 'master']
+        assert cl.ec2.calls == 1
+        self.assertRaises(exception.InstanceDoesNotExist, cl.get_node,
+                          'node001', nodes=[nodes[0]])
+        assert cl.get_node('i-2', nodes=nodes) is nodes[0]
@@ -0,0 +1,126 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import tempfile
+import subprocess
+logging.disable(logging.WARN)
+
+from starcluster import tests
+from starcluster import threadpool
+from starcluster.tests.fakes import FooSSH
+from starcluster.tests.fakes import FooNode
+from starcluster.tests.fakes import FooInstance
+from starcluster.tests.fakes import output
+
+FACTS = output(['num_processors=4', 'memory=7479', 'machine=x86_64',
+                'distro=ubuntu 14.04', 'package_provider=apt',
+                'timezone=UTC'])
+
+
+def run_on(hosts_file):
+    """
+    Returns a FooSSH respond function running the commands locally against
+    hosts_file instead of /etc/hosts
+    """
+    def respond(ssh, command):
+        command = command.replace('/etc/hosts', hosts_file)
+        subprocess.check_call(['bash', '-c', command])
+    return respond
+
+
+def useradd(ssh, command):
+    if command.startswith('useradd'):
+        ssh.files['/etc/passwd'] += 'foo:x:1000:1000::/home/foo:/bin/sh\n'
+
+
+class TestNode(tests.StarClusterTest):
+
+    def test_copy_remote_files_to_nodes(self):
+        master = FooNode('master', ssh=FooSSH(files={
+            '/etc/hosts': 'hosts', '/root/.ssh/id_rsa': 'key'}))
+        nodes = [FooNode('node%.3d' % i) for i in range(1, 6)]
+        pool = threadpool.get_thread_pool(size=3)
+        try:
+            master.copy_remote_files_to_nodes(
+                ['/etc/hosts', ('/root/.ssh/id_rsa', '/tmp/id_rsa')],
+                [master] + nodes, pool=pool)
+        finally:
+            pool.shutdown()
+        # each file is only downloaded once
+        assert master.ssh.gets == 2
+        for node in nodes:
+            assert node.ssh.files == {'/etc/hosts': 'hosts',
+                                      '/tmp/id_rsa': 'key'}
+            attrs = node.ssh.sftp.attrs['/tmp/id_rsa']
+            assert attrs == {'owner': (1000, 1001), 'mode': 0600}
+        # src and dest are the same on the master
+        assert master.ssh.files['/tmp/id_rsa'] == 'key'
+        assert '/etc/hosts' not in master.ssh.sftp.attrs
+
+    def test_append_to_etc_hosts(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write("127.0.0.1 localhost\n"
+                    "10.0.0.1 master master\n"
+                    "10.0.0.2 node001 node001\n"
+                    "10.0.0.3 node0010 node0010\n")
+            f.flush()
+            n = FooNode("master", "10.0.0.1", FooSSH(run_on(f.name)))
+            new = [FooNode("node001", "10.0.0.12"),
+                   FooNode("node002", "10.0.0.13")]
+            n.append_to_etc_hosts(new)
+            assert len(n.ssh.commands) == 1
+            # sed -i replaces the file so it has to be reopened
+            with open(f.name) as hosts:
+                lines = hosts.read().splitlines()
+            assert lines == ["127.0.0.1 localhost",
+                             "10.0.0.1 master master",
+                             "10.0.0.3 node0010 node0010",
+                             "10.0.0.12 node001 node001",
+                             "10.0.0.13 node002 node002"]
+
+    def test_user_cache(self):
+        node = FooNode('node001', ssh=FooSSH(useradd, files={
+            '/etc/passwd': 'root:x:0:0:root:/root:/bin/bash\n',
+            '/etc/group': 'root:x:0:\n'}))
+        assert node.getpwnam('root').pw_dir == '/root'
+        assert node.getpwuid(0).pw_name == 'root'
+        assert node.getgrgid(0).gr_name == 'root'
+        assert node.getgrnam('root').gr_gid == 0
+        assert node.ssh.reads == 2
+        assert node.getpwnam('foo') is None
+        node.add_user('foo', uid=1000)
+        assert node.getpwnam('foo').pw_uid == 1000
+        assert node.ssh.reads == 3
+
+    def test_node_facts(self):
+        instance = FooInstance('i-1', 'node001', '@sc-foo')
+        node = FooNode('node001', ssh=FooSSH(FACTS), instance=instance)
+        assert node.num_processors == 4
+        assert node.memory == 7479.0
+        assert node.package_provider == 'apt'
+        assert node.facts['distro'] == 'ubuntu 14.04'
+        assert len(node.ssh.commands) == 1
+        # a new Node object for the same instance reuses the saved facts
+        node = FooNode('node001', ssh=FooSSH(FACTS), instance=instance)
+        assert node.num_processors == 4
+        assert node.ssh.commands == []
+        # facts are gathered again if the instance type changed
+        instance.instance_type = 'm3.2xlarge'
+        node = FooNode('node001', ssh=FooSSH(FACTS), instance=instance)
+        assert node.num_processors == 4
+        assert len(node.ssh.commands) == 1
@@ -15,8 +15,11 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import iso8601
 import datetime
+import tempfile
+import subprocess
 
 from starcluster import utils
 from starcluster.balancers import sge
@@ -24,6 +27,52 @@ from starcluster.tests import StarClusterTest
 from starcluster.tests.templates import sge_balancer
 
 
+class FooNode(object):
+    def __init__(self, alias):
+        self.alias = alias
+        self.id = 'i-%s' % alias
+
+
+class FooDateSSH(object):
+    def __init__(self, date_str):
+        self.date_str = date_str
+        self.calls = 0
+
+    def execute(self, cmd):
+        self.calls += 1
+        return [self.date_str]
+
+
+class FooDateMaster(object):
+    def __init__(self, date_str):
+        self.ssh = FooDateSSH(date_str)
+
+
+class FooDateCluster(object):
+    def __init__(self, date_str):
+        self.master_node = FooDateMaster(date_str)
+
+
+class FooAccountingSSH(object):
+    """Runs commands locally against a temporary accounting file"""
+    def __init__(self, accounting_file):
+        self.accounting_file = accounting_file
+
+    def execute(self, cmd):
+        return list(self.execute_stream(cmd))
+
+    def execute_stream(self, cmd):
+        cmd = cmd.replace(sge.ACCOUNTING_FILE, self.accounting_file)
+        out = subprocess.check_output(['bash', '-c', cmd])
+        for line in out.split('\n'):
+            yield line.strip()
+
+
+class FooAccountingMaster(object):
+    def __init__(self, accounting_file):
+        self.ssh = FooAccountingSSH(accounting_file)
+
+
 class TestSGELoadBalancer(StarClusterTest):
 
     def test_qhost_parser(self):
@@ -76,6 +125,127 @@ class TestSGELoadBalancer(StarClusterTest):
         stat.parse_qhost(sge_balancer.loaded_qhost_xml)
         assert stat.slots_per_host() == 8
 
+    def test_streamed_qstat_parser(self):
+        stat = sge.SGEStats()
+        lines = iter(sge_balancer.loaded_qstat_xml.splitlines())
+        stat_hash = stat.parse_qstat(lines)
+        assert len(stat_hash) == 192
+        assert len(stat.queues) == 10
+        assert stat.count_total_slots() == 80
+        assert stat.jobs[0]['queue_name'] == \
+            'all.q@domU-12-31-39-0B-C4-C1.compute-1.internal'
+        assert 'JB_name' not in stat.jobs[0]
+        host_hash = stat.parse_qhost(
+            iter(sge_balancer.loaded_qhost_xml.splitlines()))
+        assert len(host_hash) == 10
+        assert stat.slots_per_host() == 8
+
+    def test_large_qstat_parser(self):
+        stat = sge.SGEStats()
+        xml = sge_balancer.scale_qstat_xml(sge_balancer.loaded_qstat_xml, 50)
+        stat_hash = stat.parse_qstat(xml)
+        assert len(stat_hash) == 192 * 50
+        assert len(stat.get_running_jobs()) == 4 * 50
+        assert len(stat.get_queued_jobs()) == 188 * 50
+
+    def test_large_qhost_parser(self):
+        stat = sge.SGEStats()
+        xml = sge_balancer.scale_qhost_xml(sge_balancer.loaded_qhost_xml, 50)
+        hosts = stat.parse_qhost(xml)
+        assert len(hosts) == 10 * 50
+        assert len(set([h['name'] for h in hosts])) == 10 * 50
+        assert hosts[-1]['name'] == \
+            'domU-12-31-39-0E-FE-71.compute-1.internal-49'
+        assert hosts[-1]['num_proc'] == '8'
+
+    def test_task_array_jobs(self):
+        stat = sge.SGEStats()
+        job = """
+      <job_list state="pending">
+        <JB_job_number>600</JB_job_number>
+        <JB_submission_time>2010-07-08T04:40:46</JB_submission_time>
+        <state>qw</state>
+        <slots>2</slots>
+        <tasks>1-1000000:1</tasks>
+      </job_list>
+"""
+        xml = sge_balancer.qstat_xml.replace('  </job_info>\n</job_info>',
+                                             job + '  </job_info>\n'
+                                             '</job_info>')
+        stat.parse_qstat(xml)
+        queued = stat.get_queued_jobs()
+        assert len(queued) == 21
+        assert stat.count_tasks(queued) == 20 + 1000000
+        assert stat.count_slots(queued) == 20 + 2 * 1000000
+        assert stat.count_tasks(stat.get_running_jobs()) == 3
+
     def test_node_working(self):
-        # TODO : FINISH THIS
-        pass
+        stat = sge.SGEStats()
+        stat.parse_qstat(sge_balancer.loaded_qstat_xml)
+        working = FooNode('domU-12-31-39-0B-C4-C1')
+        idle = FooNode('domU-12-31-39-0B-C4-61')
+        assert stat.is_node_working(working)
+        assert not stat.is_node_working(idle)
+        stat.parse_qstat(sge_balancer.qstat_xml)
+        assert not stat.is_node_working(working)
+        assert stat.is_node_working(FooNode('ip-10-196-142-180'))
+
+    def test_remote_time_cached(self):
+        lb = sge.SGELoadBalancer()
+        lb._cluster = FooDateCluster('2010-06-18T23:39:14-0400')
+        ssh = lb._cluster.master_node.ssh
+        first = lb.get_remote_time()
+        for i in range(10):
+            now = lb.get_remote_time()
+        assert ssh.calls == 1
+        assert now.utcoffset() == datetime.timedelta(hours=-4)
+        assert now - first < datetime.timedelta(seconds=5)
+        assert lb.stat.remote_tzinfo == now.tzinfo
+        lb.get_remote_time(refresh=True)
+        assert ssh.calls == 2
+        lb._clock_synced -= datetime.timedelta(
+            seconds=lb.clock_sync_interval)
+        lb.get_remote_time()
+        assert ssh.calls == 3
+
+    def test_accounting_parser(self):
+        stat = sge.SGEStats()
+        stat.parse_accounting(sge_balancer.accounting_txt.splitlines())
+        assert stat.max_job_id == 6
+        assert stat.avg_job_duration() == 60
+        assert stat.avg_wait_time() == 81
+        stat = sge.SGEStats()
+        since = datetime.datetime(2010, 7, 15, 18, 21,
+                                  tzinfo=iso8601.iso8601.UTC)
+        stat.parse_accounting(sge_balancer.accounting_txt.splitlines(),
+                              since=since)
+        assert stat.max_job_id == 6
+        assert len([j for j in stat.jobstats if j]) == 2
+
+    def test_accounting_tail(self):
+        # trailing whitespace is stripped from the remote output lines
+        acct = sge_balancer.accounting_txt.replace(':0:0\n', ':0:0  \r\n', 2)
+        partial = acct.index('sleep:3:')
+        fd, path = tempfile.mkstemp()
+        os.write(fd, acct[:partial])
+        lb = sge.SGELoadBalancer()
+        lb._stat = sge.SGEStats()
+        master = FooAccountingMaster(path)
+        now = datetime.datetime(2010, 7, 15, 19, 0,
+                                tzinfo=iso8601.iso8601.UTC)
+        try:
+            lb._parse_new_accounting(master, now)
+            assert lb.stat.max_job_id == 4
+            assert lb._accounting_offset == acct.rindex('\n', 0, partial) + 1
+            os.write(fd, acct[partial:])
+            lb._parse_new_accounting(master, now)
+            assert lb.stat.max_job_id == 6
+            assert lb._accounting_offset == len(acct)
+            assert lb.stat.avg_wait_time() == 81
+            with open(path, 'w') as f:
+                f.write(acct[:acct.index('all.q')])
+            lb._parse_new_accounting(master, now)
+            assert lb._accounting_offset == acct.index('all.q')
+        finally:
+            os.close(fd)
+            os.remove(path)
@@ -0,0 +1,158 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import subprocess
+
+import logging
+logging.disable(logging.WARN)
+
+from starcluster import tests
+from starcluster.plugins.sge import SGEPlugin
+from starcluster.tests.fakes import FooSSH
+from starcluster.tests.fakes import FooNode
+from starcluster.tests.fakes import FooRecordingNode
+
+
+class FooQconf(object):
+    """
+    FooSSH respond function faking the qconf calls of the SGE plugin, with a
+    single 'smp' parallel environment of pe_slots slots (None if it does not
+    exist)
+    """
+    def __init__(self, pe_slots):
+        self.pe_slots = pe_slots
+
+    def __call__(self, ssh, command):
+        if command.startswith('n=') or command.startswith('rm -f'):
+            # the PE updates count, in a local SGE_ROOT
+            return subprocess.check_output(command, shell=True).splitlines()
+        if ' && rm -f ' in command:
+            command, reset = command.split(' && ')
+            self(ssh, reset)
+        if command == 'qconf -sp smp':
+            if self.pe_slots is None:
+                ssh.status = 1
+                return ['error: parallel environment "smp" does not exist']
+            return ['pe_name smp', 'slots %d' % self.pe_slots]
+        if command.startswith('qconf -mattr pe slots'):
+            self.pe_slots = int(command.split()[4])
+        if command.endswith('util/arch'):
+            return ['lx-amd64']
+
+
+class FooWavePool(object):
+    def __init__(self):
+        self.jobs = []
+        self.waves = []
+
+    def simple_job(self, method, args=None, kwargs=None, jobid=None):
+        self.jobs.append(jobid)
+
+    def wait(self, numtasks=None):
+        self.waves.append(self.jobs)
+        self.jobs = []
+
+
+class TestSGEPlugin(tests.StarClusterTest):
+
+    def test_pe_slots_delta(self):
+        sge_root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(sge_root, 'default', 'common'))
+        counter = os.path.join(sge_root, SGEPlugin.PE_UPDATES_FILE % 'smp')
+        qconf = FooQconf(8)
+        nodes = [FooRecordingNode('node%.3d' % i, '10.0.0.%d' % i)
+                 for i in range(1, 4)]
+        reconciled = []
+
+        def get_plugin():
+            plugin = SGEPlugin(slots_per_host=2, disable_threads=True)
+            plugin.SGE_ROOT = sge_root
+            plugin.PE_RECONCILE_INTERVAL = 3
+            plugin._master = FooNode('master', ssh=FooSSH(qconf))
+            create_sge_pe = plugin._create_sge_pe
+
+            def reconcile(name, nodes):
+                reconciled.append(nodes)
+                create_sge_pe(name=name, nodes=nodes)
+            plugin._create_sge_pe = reconcile
+            return plugin
+        try:
+            plugin = get_plugin()
+            plugin._update_sge_pe(added_slots=4)
+            assert qconf.pe_slots == 12
+            plugin._update_sge_pe(removed_slots=2)
+            assert qconf.pe_slots == 10
+            assert reconciled == []
+            # periodic reconciliation, counted across plugin instances (one
+            # per addnode/removenode run)
+            plugin = get_plugin()
+            plugin._update_sge_pe(nodes=nodes, added_slots=2)
+            assert reconciled == [nodes]
+            assert qconf.pe_slots == 6
+            assert not os.path.exists(counter)
+            # unknown slots of a removed host
+            plugin._update_sge_pe(nodes=nodes[:1], removed_slots=None)
+            assert reconciled == [nodes, nodes[:1]]
+            assert qconf.pe_slots == 2
+        finally:
+            shutil.rmtree(sge_root)
+
+    def test_batched_host_registration(self):
+        plugin = SGEPlugin(slots_per_host=2, disable_threads=True)
+        plugin.QCONF_BATCH_SIZE = 2
+        plugin._master = FooNode('master', ssh=FooSSH(FooQconf(8)))
+        nodes = [FooNode('node%.3d' % i) for i in range(1, 4)]
+        plugin._add_sge_admin_submit_hosts(nodes)
+        plugin._add_sge_exec_hosts(nodes)
+        commands = plugin._master.ssh.commands
+        assert commands[0] == ('qconf -ah node001,node002 && '
+                               'qconf -as node001,node002')
+        assert commands[1] == 'qconf -ah node003 && qconf -as node003'
+        assert len(commands) == 4
+        assert commands[3] == (
+            'qconf -aattr hostgroup hostlist node003 @allhosts && '
+            'qconf -aattr queue slots "[node003=2]" all.q')
+
+    def test_arch_per_ami(self):
+        plugin = SGEPlugin(disable_threads=True)
+        nodes = []
+        for i in range(3):
+            node = FooNode('node%.3d' % i, ssh=FooSSH(FooQconf(None)))
+            node.instance.image_id = 'ami-%d' % (i % 2)
+            nodes.append(node)
+        for node in nodes:
+            plugin._get_sge_arch(node)
+        assert [len(n.ssh.commands) for n in nodes] == [1, 1, 0]
+        # the lookups of different AMIs do not wait for each other
+        assert sorted(plugin._sge_arch_locks) == ['ami-0', 'ami-1']
+
+    def test_install_waves(self):
+        nodes = [FooRecordingNode('node%.3d' % i, '10.0.0.%d' % i)
+                 for i in range(1, 6)]
+        plugin = SGEPlugin(disable_threads=True, install_wave_size=2)
+        plugin._pool = FooWavePool()
+        plugin._add_nodes_to_sge(nodes)
+        assert plugin._pool.waves == [['node001', 'node002'],
+                                      ['node003', 'node004'], ['node005']]
+        # by default all the nodes are installed at once
+        plugin = SGEPlugin(disable_threads=True)
+        plugin._pool = FooWavePool()
+        plugin._add_nodes_to_sge(nodes)
+        assert plugin._pool.waves == [[n.alias for n in nodes]]
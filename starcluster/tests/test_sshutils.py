@@ -0,0 +1,238 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import gc
+import logging
+logging.disable(logging.WARN)
+
+from starcluster import tests
+from starcluster import sshutils
+from starcluster import threadpool
+from starcluster import exception
+
+
+class FooChannel(object):
+    def __init__(self, transport):
+        self.transport = transport
+        self.closed = False
+        self.eof_received = True
+        self.stdout = None
+        self.stderr = ''
+
+    def settimeout(self, timeout):
+        pass
+
+    def exec_command(self, command):
+        self.command = command
+        self.transport.running.append(command)
+        if 'seq' in command:
+            self.stdout = ''.join(['%d\n' % i for i in range(10000)])
+            self.stderr = 'warning\n'
+
+    def _get_stdout(self):
+        if self.stdout is None:
+            # all the commands were started before any output is read
+            self.stdout = '%d\n' % len(self.transport.running)
+        return self.stdout
+
+    def recv_ready(self):
+        return len(self._get_stdout()) > 0
+
+    def recv(self, nbytes):
+        data, self.stdout = self.stdout[:nbytes], self.stdout[nbytes:]
+        return data
+
+    def recv_stderr_ready(self):
+        return len(self.stderr) > 0
+
+    def recv_stderr(self, nbytes):
+        data, self.stderr = self.stderr[:nbytes], self.stderr[nbytes:]
+        return data
+
+    def exit_status_ready(self):
+        return True
+
+    def recv_exit_status(self):
+        return 1 if 'false' in self.command else 0
+
+    def close(self):
+        self.closed = True
+
+
+class FooLateChannel(FooChannel):
+    """
+    Channel whose exit status is ready before the last of its output and its
+    EOF were received
+    """
+    def __init__(self, transport):
+        FooChannel.__init__(self, transport)
+        self.eof_received = False
+        self.stdout = 'first\n'
+        self.polls = 0
+        self._r, self._w = os.pipe()
+        os.write(self._w, 'x')
+
+    def fileno(self):
+        # always readable: select returns at once
+        return self._r
+
+    def recv_ready(self):
+        self.polls += 1
+        if self.polls == 4:
+            self.stdout += 'last\n'
+        elif self.polls > 4 and not self.stdout:
+            self.eof_received = True
+        return len(self.stdout) > 0
+
+    def close(self):
+        FooChannel.close(self)
+        os.close(self._r)
+        os.close(self._w)
+
+
+class FooTransport(object):
+    def __init__(self, channel_class=FooChannel):
+        self.active = True
+        self.keepalive = None
+        self.running = []
+        self.channel_class = channel_class
+
+    def open_session(self):
+        return self.channel_class(self)
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        self.keepalive = interval
+
+    def send_ignore(self):
+        pass
+
+    def close(self):
+        self.active = False
+
+
+class TestSSHConnectionPool(tests.StarClusterTest):
+
+    def test_reuse(self):
+        pool = sshutils.SSHConnectionPool(keepalive=30, idle_timeout=300)
+        key = ('master', 22, 'root')
+        t1 = pool.acquire(key, FooTransport)
+        t2 = pool.acquire(key, FooTransport)
+        assert t1 is t2
+        assert t1.keepalive == 30
+        assert pool.acquire(('master', 22, 'sgeadmin'), FooTransport) \
+            is not t1
+        pool.release(key, t1)
+        pool.release(key, t1)
+        assert pool.acquire(key, FooTransport) is t1
+        t1.active = False
+        t3 = pool.acquire(key, FooTransport)
+        assert t3 is not t1
+        pool.discard_host('master')
+        assert not t3.active
+
+    def test_idle_eviction(self):
+        pool = sshutils.SSHConnectionPool(idle_timeout=-1)
+        key = ('node001', 22, 'root')
+        t1 = pool.acquire(key, FooTransport)
+        pool.release(key, t1)
+        t2 = pool.acquire(key, FooTransport)
+        assert t2 is not t1
+        assert not t1.active
+
+
+class TestSSHClient(tests.StarClusterTest):
+
+    def test_connect(self):
+        pool = sshutils.connection_pool
+        key = ('gc-test', 22, 'root')
+        client = sshutils.SSHClient('gc-test', username='root', password='x')
+        client._new_transport = lambda *args: FooTransport()
+        client.connect()
+        transport = client.transport
+        # the sftp session is only opened on the first file operation
+        assert client._session.sftp is None
+        assert transport.running == []
+        assert pool._transports[key][1] == 1
+        # clients that were never closed give their transport back
+        del client
+        gc.collect()
+        pool.acquire(('gc-test2', 22, 'root'), FooTransport)
+        try:
+            assert pool._transports[key][1] == 0
+            assert pool._transports[key][0] is transport
+        finally:
+            pool.discard_host('gc-test')
+            pool.discard_host('gc-test2')
+
+    def _get_client(self, channel_class=FooChannel):
+        client = sshutils.SSHClient('master', username='root', password='x')
+        client._session.transport = FooTransport(channel_class)
+        return client
+
+    def test_execute_many(self):
+        client = self._get_client()
+        results = client.execute_many(['true', 'true', 'true'],
+                                      source_profile=False)
+        assert results == [(0, ['3'])] * 3
+        results = client.execute_many(['true', 'false'],
+                                      ignore_exit_status=True)
+        assert [status for status, output in results] == [0, 1]
+        self.assertRaises(exception.RemoteCommandFailed,
+                          client.execute_many, ['false', 'true'])
+        assert len(client._session.transport.running) == 7
+
+    def test_execute_many_host_limit(self):
+        client = self._get_client()
+        limiter = threadpool.HostLimiter(max_per_host=2)
+        default_limiter = threadpool._host_limiter
+        threadpool._host_limiter = limiter
+        try:
+            results = client.execute_many(['true'] * 5, source_profile=False)
+        finally:
+            threadpool._host_limiter = default_limiter
+        # the output reports the number of commands started before it was
+        # read: only two channels were ever open at once
+        assert results == [(0, [str(n)]) for n in (2, 3, 4, 5, 5)]
+        # all the slots were released
+        assert limiter.acquire('master', blocking=False)
+        assert limiter.acquire('master', blocking=False)
+
+    def test_execute_stream(self):
+        client = self._get_client()
+        client.STREAM_BUFSIZE = 100
+        lines = client.execute_stream('seq 0 9999', source_profile=False)
+        assert lines.next() == '0'
+        assert len(client._session.transport.running) == 1
+        lines = list(lines)
+        assert len(lines) == 10000
+        assert lines[-1] == '9999'
+        assert 'warning' in lines
+        assert client.get_last_status() == 0
+        self.assertRaises(exception.RemoteCommandFailed, list,
+                          client.execute_stream('false'))
+        assert client.execute('seq 0 9999')[-1] == 'warning'
+
+    def test_output_after_exit_status(self):
+        client = self._get_client(FooLateChannel)
+        assert client.execute('foo', source_profile=False) == ['first',
+                                                               'last']
+        lines = client.execute_stream('foo', source_profile=False)
+        assert list(lines) == ['first', 'last']
@@ -0,0 +1,225 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from starcluster import tests
+from starcluster import threadpool
+from starcluster import streaming_node_add
+from starcluster.node import Node
+
+
+class FooStreamNode(Node):
+    """
+    Node that is running (or pending) and whose SSH comes up after a given
+    number of probes
+    """
+    def __init__(self, id, state='running', up_after=0):
+        self._id = id
+        self._alias = 'node-%s' % id
+        self._ssh = None
+        self._state = state
+        self.up_after = up_after
+        self.probes = []
+        self.reboots = 0
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def state(self):
+        return self._state
+
+    def is_up(self, update=True):
+        self.probes.append(update)
+        return len(self.probes) > self.up_after
+
+    def reboot(self):
+        self.reboots += 1
+
+
+class FooSpot(object):
+    def __init__(self, id, instance_id):
+        self.id = id
+        self.instance_id = instance_id
+        self.state = 'active'
+
+
+class FooStreamEC2(object):
+    def __init__(self, propagate_after=0):
+        self.propagate_after = propagate_after
+        self.calls = 0
+
+    def check_for_propagation(self, instance_ids=None, spot_ids=None):
+        self.calls += 1
+        if self.calls <= self.propagate_after:
+            return [], []
+        return spot_ids or [], instance_ids or []
+
+    def cancel_stuck_spot_instance_request(self, spots):
+        return spots
+
+
+class FooStreamCluster(object):
+    refresh_interval = 0.01
+    key_location = None
+    disable_threads = True
+
+    def __init__(self, nodes, failing=None):
+        self._nodes = dict((n.id, n) for n in nodes)
+        self.failing = failing or []
+        self.ec2 = FooStreamEC2(propagate_after=1)
+        self.pool = threadpool.get_thread_pool(2, disable_threads=True)
+        self.lock = threading.Lock()
+        self.added = []
+        self.batches = []
+        self.polled = []
+        self.impaired_polls = []
+
+    @property
+    def nodes(self):
+        return self._nodes.values()
+
+    def invalidate_nodes(self):
+        pass
+
+    def get_nodes_or_raise(self, nodes=None):
+        self.polled.append([n.id for n in nodes])
+        return [self._nodes[n.id] for n in nodes if n.id in self._nodes]
+
+    def get_spot_requests_or_raise(self, spots):
+        return spots
+
+    def get_impaired_nodes(self, nodes=None):
+        self.impaired_polls.append([n.id for n in nodes])
+        return []
+
+    def run_plugins(self, method_name, node, nodes):
+        assert method_name == "on_add_nodes"
+        with self.lock:
+            self.batches.append([n.id for n in node])
+            for n in node:
+                # failing nodes can only be configured once rebooted
+                if n.id in self.failing and not n.reboots:
+                    raise Exception("failed to configure %s" % n.alias)
+            self.added.extend([n.id for n in node])
+
+
+class FooBusyPool(object):
+    """
+    Shared pool whose workers are all busy running plugin jobs
+    """
+    def map(self, fn, items, jobid_fn=None):
+        raise AssertionError("SSH probes queued behind the plugins' jobs")
+
+
+class FooStageError(Exception):
+    pass
+
+
+class TestStreamingNodeAdd(tests.StarClusterTest):
+
+    def _get_pipeline(self, cluster, instances, **kwargs):
+        return streaming_node_add.StreamingNodeAdd(
+            cluster, [], instances, reboot_interval=10, n_reboot_restart=2,
+            **kwargs)
+
+    def test_stage_handoff(self):
+        nodes = [FooStreamNode('i-%d' % i, up_after=i % 3) for i in range(6)]
+        cluster = FooStreamCluster(nodes)
+        pipeline = self._get_pipeline(
+            cluster, [FooStreamNode(n.id) for n in nodes],
+            max_configure_workers=2)
+        pipeline.run()
+        assert sorted(cluster.added) == sorted([n.id for n in nodes])
+        # instances were only propagated on the second check
+        assert cluster.ec2.calls >= 2
+        assert pipeline._remaining == 0
+        assert pipeline.instances_nrm == {}
+        for stage in pipeline.stages:
+            assert stage.queue.qsize() <= stage.num_workers
+
+    def test_probe_pool(self):
+        nodes = [FooStreamNode('i-%d' % i, up_after=1) for i in range(3)]
+        cluster = FooStreamCluster(nodes)
+        cluster.pool = FooBusyPool()
+        pipeline = self._get_pipeline(cluster,
+                                      [FooStreamNode(n.id) for n in nodes])
+        pipeline.run()
+        assert sorted(cluster.added) == ['i-0', 'i-1', 'i-2']
+        assert pipeline._probe_pool is None
+
+    def test_spots_handoff(self):
+        nodes = [FooStreamNode('i-%d' % i) for i in range(3)]
+        spots = [FooSpot('sir-%d' % i, 'i-%d' % i) for i in range(3)]
+        cluster = FooStreamCluster(nodes)
+        streaming_node_add.streaming_add(cluster, spots=spots)
+        assert sorted(cluster.added) == ['i-0', 'i-1', 'i-2']
+
+    def test_items_done(self):
+        cluster = FooStreamCluster([])
+        pipeline = self._get_pipeline(
+            cluster, [FooStreamNode('i-0'), FooStreamNode('i-1')])
+        pipeline.items_done(0)
+        pipeline.items_done(-1)
+        assert pipeline._remaining == 2
+        pipeline.items_done(1)
+        assert not pipeline.finished.is_set()
+        pipeline.items_done(1)
+        assert pipeline.finished.is_set()
+
+    def test_failed_node_rebooted(self):
+        nodes = [FooStreamNode('i-%d' % i) for i in range(3)]
+        cluster = FooStreamCluster(nodes, failing=['i-1'])
+        pipeline = self._get_pipeline(cluster,
+                                      [FooStreamNode(n.id) for n in nodes])
+        pipeline.run()
+        assert sorted(cluster.added) == ['i-0', 'i-1', 'i-2']
+        assert nodes[1].reboots == 1
+        assert [n.reboots for n in (nodes[0], nodes[2])] == [0, 0]
+        # the failed node was sent back to the boot stage and probed again
+        assert cluster.batches[-1] == ['i-1']
+        assert len(nodes[1].probes) > len(nodes[0].probes)
+
+    def test_abort(self):
+        cluster = FooStreamCluster([FooStreamNode('i-0')])
+
+        def get_nodes_or_raise(nodes=None):
+            raise FooStageError("boom")
+        cluster.get_nodes_or_raise = get_nodes_or_raise
+        pipeline = self._get_pipeline(cluster, [FooStreamNode('i-0')])
+        self.assertRaises(FooStageError, pipeline.run)
+        assert pipeline.finished.is_set()
+
+    def test_batched_status_polling(self):
+        pending = FooStreamNode('i-0', state='pending')
+        booting = FooStreamNode('i-1', up_after=5)
+        up = FooStreamNode('i-2')
+        cluster = FooStreamCluster([pending, booting, up])
+        pipeline = self._get_pipeline(cluster, [pending, booting, up])
+        waiting, forwarded = pipeline.stream_instances(
+            [FooStreamNode(n.id) for n in (pending, booting, up)])
+        assert [n.id for n in waiting] == ['i-0', 'i-1']
+        assert forwarded == 1
+        # one batched refresh and one batched impaired check per cycle
+        assert cluster.polled == [['i-0', 'i-1', 'i-2']]
+        assert cluster.impaired_polls == [['i-0', 'i-1']]
+        # only running instances are probed, without refreshing their state
+        assert pending.probes == []
+        assert booting.probes == [False]
+        assert up.probes == [False]
@@ -15,13 +15,16 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
 
+import time
 import logging
 import tempfile
+import threading
 logging.disable(logging.WARN)
 
 from starcluster import tests
 from starcluster import exception
 from starcluster import threadpool
+from starcluster.clustersetup import DefaultClusterSetup
 
 
 class TestThreadPool(tests.StarClusterTest):
@@ -137,3 +140,87 @@ class TestThreadPool(tests.StarClusterTest):
         except exception.ThreadPoolException, e:
             assert len(e.exceptions) == r
             assert self.pool._exception_queue.qsize() == 0
+
+    def test_map_order(self):
+        calc = self.pool.map(lambda x: time.sleep(0.01 * (10 - x)) or x,
+                             range(10))
+        assert calc == range(10)
+
+    def test_submit(self):
+        futures = [self.pool.submit(self._args_and_kwargs, (i,),
+                                    kwargs=dict(mykw=self._mykw), jobid=i)
+                   for i in range(self._jobs)]
+        assert [f.result() for f in futures] == \
+            zip(range(self._jobs), [dict(mykw=self._mykw)] * self._jobs)
+        future = self.pool.submit(self._args_only, ('1', 2), jobid='bad')
+        exc, tb_msg, jobid = future.exception()
+        assert jobid == 'bad'
+        self.assertRaises(exception.ThreadPoolException, future.result)
+        assert self.pool._exception_queue.qsize() == 0
+
+    def test_concurrent_waits(self):
+        pool = self.pool
+        results = {}
+
+        def run(n):
+            for i in range(self._jobs):
+                pool.simple_job(lambda x: time.sleep(0.01) or x * n, i)
+            results[n] = pool.wait()
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in (1, 10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results[1] == range(self._jobs)
+        assert results[10] == range(0, self._jobs * 10, 10)
+
+    def test_nested_map(self):
+        pool = threadpool.get_thread_pool(1, disable_threads=False)
+        pool.progress_bar.fd = tempfile.TemporaryFile()
+        calc = pool.map(lambda x: sum(pool.map(lambda y: y, range(x))),
+                        range(5))
+        assert calc == [0, 0, 1, 3, 6]
+        pool.shutdown()
+
+    def test_host_limit(self):
+        limiter = threadpool.HostLimiter(max_per_host=2)
+        lock = threading.Lock()
+        running = {'master': 0, 'node001': 0}
+        peak = {'master': 0, 'node001': 0}
+
+        def run(host):
+            with limiter.limit(host):
+                with lock:
+                    running[host] += 1
+                    peak[host] = max(peak[host], running[host])
+                time.sleep(0.01)
+                with lock:
+                    running[host] -= 1
+
+        self.pool.map(run, ['master'] * 6 + ['node001'] * 6)
+        assert peak == {'master': 2, 'node001': 2}
+
+    def test_shared_pool(self):
+        pool = threadpool.get_shared_pool()
+        assert threadpool.get_shared_pool() is pool
+        assert threadpool.get_shared_pool(disable_threads=True) is not pool
+
+    def test_configure_num_threads(self):
+        pool = threadpool._shared_pool
+        size = threadpool._shared_pool_size
+        limiter = threadpool._host_limiter
+        try:
+            threadpool._shared_pool = None
+            DefaultClusterSetup(num_threads='40')
+            assert threadpool._shared_pool_size == 40
+            # the per-host limit is left untouched
+            assert threadpool._host_limiter is limiter
+            # too late to resize the shared pool once it was created
+            threadpool._shared_pool = threadpool.get_thread_pool(
+                disable_threads=True)
+            DefaultClusterSetup(num_threads=10)
+            assert threadpool._shared_pool_size == 40
+        finally:
+            threadpool._shared_pool = pool
+            threadpool._shared_pool_size = size
@@ -18,9 +18,10 @@
 """
 ThreadPool module for StarCluster based on WorkerPool
 """
-import time
 import Queue
 import thread
+import threading
+import contextlib
 import traceback
 import workerpool
 
@@ -60,9 +61,60 @@ def _worker_factory(parent):
     return DaemonWorker(parent)
 
 
+class Future(object):
+    """
+    Handle on the result of a job submitted with ThreadPool.submit
+    """
+    def __init__(self, jobid=None):
+        self.jobid = jobid
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, e, tb_msg):
+        jobid = self.jobid
+        if jobid is None:
+            jobid = str(thread.get_ident())
+        self._exception = [e, tb_msg, jobid]
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the job to complete, returns True if it did within timeout
+        """
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def exception(self):
+        """
+        Wait for the job and return its [exception, traceback, jobid] if it
+        failed, None otherwise
+        """
+        self.wait()
+        return self._exception
+
+    def result(self):
+        """
+        Wait for the job and return its result or raise a ThreadPoolException
+        if it failed
+        """
+        self.wait()
+        if self._exception:
+            raise exception.ThreadPoolException(
+                "An error occurred in ThreadPool", [self._exception])
+        return self._result
+
+
 class SimpleJob(workerpool.jobs.SimpleJob):
     def __init__(self, method, args=None, kwargs=None, jobid=None,
-                 results_queue=None):
+                 results_queue=None, future=None):
         self.method = method
         if args is None:
             self.args = []
@@ -74,8 +126,25 @@ class SimpleJob(workerpool.jobs.SimpleJob):
             self.kwargs = kwargs
         self.jobid = jobid
         self.results_queue = results_queue
+        self.future = future
 
     def run(self):
+        if self.future:
+            try:
+                r = self._call()
+            except Exception, e:
+                self.future.set_exception(e, traceback.format_exc())
+                return self.future
+            if self.results_queue:
+                self.results_queue.put(r)
+            self.future.set_result(r)
+            return self.future
+        r = self._call()
+        if self.results_queue:
+            return self.results_queue.put(r)
+        return r
+
+    def _call(self):
         if isinstance(self.args, list) or isinstance(self.args, tuple):
             if isinstance(self.kwargs, dict):
                 r = self.method(*self.args, **self.kwargs)
@@ -88,8 +157,6 @@ class SimpleJob(workerpool.jobs.SimpleJob):
                 r = self.method(self.args)
         else:
             r = self.method()
-        if self.results_queue:
-            return self.results_queue.put(r)
         return r
 
 
@@ -98,8 +165,9 @@ class ThreadPool(workerpool.WorkerPool):
                  disable_threads=False):
         self.disable_threads = disable_threads
         self._exception_queue = Queue.Queue()
-        self._results_queue = Queue.Queue()
+        self._jobs_local = threading.local()
         self._progress_bar = None
+        self._progress_bar_lock = threading.Lock()
         if self.disable_threads:
             size = 0
         workerpool.WorkerPool.__init__(self, size, maxjobs, worker_factory)
@@ -115,30 +183,91 @@ class ThreadPool(workerpool.WorkerPool):
             self._progress_bar = pbar
         return self._progress_bar
 
+    @property
+    def _job_group(self):
+        """
+        Futures of the jobs submitted with simple_job by the calling thread
+        and not waited for yet
+        """
+        if not hasattr(self._jobs_local, 'futures'):
+            self._jobs_local.futures = []
+        return self._jobs_local.futures
+
+    def _in_worker_thread(self):
+        return getattr(threading.current_thread(), 'jobs', None) is self
+
     def simple_job(self, method, args=None, kwargs=None, jobid=None,
                    results_queue=None):
+        """
+        Submit a job whose result will be returned by the next call to wait()
+        made by the same thread. If results_queue is given the result is also
+        put in it.
+        """
+        future = self.submit(method, args=args, kwargs=kwargs, jobid=jobid,
+                             results_queue=results_queue)
+        self._job_group.append(future)
+        return future
+
+    def submit(self, method, args=None, kwargs=None, jobid=None,
+               results_queue=None):
+        """
+        Run method(*args, **kwargs) in the pool and return a Future for its
+        result. Each future is its own result and error channel so concurrent
+        and nested fan-outs on the same pool never see each other's results.
+
+        Jobs submitted from one of this pool's worker threads (i.e. by a job)
+        run inline: waiting on them from a worker could otherwise deadlock
+        the pool once all of its workers are waiting.
+        """
         if args is None:
             args = []
         if kwargs is None:
             kwargs = {}
-        results_queue = results_queue or self._results_queue
+        future = Future(jobid=jobid)
         job = SimpleJob(method, args, kwargs, jobid,
-                        results_queue=results_queue)
-        if not self.disable_threads:
-            return self.put(job)
+                        results_queue=results_queue, future=future)
+        if self.disable_threads or self._in_worker_thread():
+            job.run()
         else:
-            return job.run()
+            self.put(job)
+        return future
 
-    def get_results(self):
-        results = []
-        for i in range(self._results_queue.qsize()):
-            results.append(self._results_queue.get())
-        return results
+    def wait_futures(self, futures):
+        """
+        Wait for all futures and return their results in the same order.
+        Raises a ThreadPoolException with the errors of all the jobs that
+        failed.
+
+        The progress bar is only displayed by the first of concurrent or
+        nested waits.
+        """
+        if self._progress_bar_lock.acquire(False):
+            try:
+                pbar = self.progress_bar.reset()
+                pbar.maxval = len(futures)
+                for future in futures:
+                    while not future.wait(1):
+                        pbar.update(len(filter(lambda f: f.done(), futures)))
+                if pbar.maxval != 0:
+                    pbar.update(len(futures))
+                    pbar.finish()
+            finally:
+                self._progress_bar_lock.release()
+        else:
+            for future in futures:
+                future.wait()
+        excs = filter(None, [f.exception() for f in futures])
+        if excs:
+            self.printExceptions(excs)
+            raise exception.ThreadPoolException(
+                "An error occurred in ThreadPool", excs)
+        return [f.result() for f in futures]
 
     def map(self, fn, *seq, **kwargs):
         """
         Uses the threadpool to return a list of the results of applying the
-        function to the items of the argument sequence(s). If more than one
+        function to the items of the argument sequence(s), in the same order as
+        the items. If more than one
         sequence is given, the function is called with an argument list
         consisting of the corresponding item of each sequence. If more than one
         sequence is given with different lengths the argument list will be
@@ -148,16 +277,15 @@ class ThreadPool(workerpool.WorkerPool):
         assigned a jobid based on the return value of jobid_fn(item) for each
         item in the map.
         """
-        if self._results_queue.qsize() > 0:
-            self.get_results()
         args = zip(*seq)
         jobid_fn = kwargs.get('jobid_fn')
+        futures = []
         for seq in args:
             jobid = None
             if jobid_fn:
                 jobid = jobid_fn(*seq)
-            self.simple_job(fn, seq, jobid=jobid)
-        return self.wait(numtasks=len(args))
+            futures.append(self.submit(fn, seq, jobid=jobid))
+        return self.wait_futures(futures)
 
     def store_exception(self, e):
         self._exception_queue.put(e)
@@ -165,21 +293,18 @@ class ThreadPool(workerpool.WorkerPool):
     def shutdown(self):
         log.info("Shutting down threads...")
         workerpool.WorkerPool.shutdown(self)
-        self.wait(numtasks=self.size())
+        self.join()
 
     def wait(self, numtasks=None, return_results=True):
-        pbar = self.progress_bar.reset()
-        pbar.maxval = self.unfinished_tasks
-        if numtasks is not None:
-            pbar.maxval = max(numtasks, self.unfinished_tasks)
-        while self.unfinished_tasks != 0:
-            finished = pbar.maxval - self.unfinished_tasks
-            pbar.update(finished)
-            log.debug("unfinished_tasks = %d" % self.unfinished_tasks)
-            time.sleep(1)
-        if pbar.maxval != 0:
-            pbar.finish()
-        self.join()
+        """
+        Wait for the jobs submitted with simple_job by the calling thread and
+        return their results in submission order. Jobs submitted by other
+        threads are not waited for. numtasks is only kept for backward
+        compatibility.
+        """
+        futures = self._job_group
+        self._jobs_local.futures = []
+        results = self.wait_futures(futures)
         exc_queue = self._exception_queue
         if exc_queue.qsize() > 0:
             self.printExceptions()
@@ -187,15 +312,17 @@ class ThreadPool(workerpool.WorkerPool):
             raise exception.ThreadPoolException(
                 "An error occurred in ThreadPool", excs)
         if return_results:
-            return self.get_results()
+            return results
 
     def __del__(self):
         log.debug('del called in threadpool')
         self.shutdown()
         self.join()
 
-    def printExceptions(self):
-        for exc_arr in self._exception_queue.queue:
+    def printExceptions(self, excs=None):
+        if excs is None:
+            excs = self._exception_queue.queue
+        for exc_arr in excs:
             log.error("-------threadpool exc start---------")
             e = exc_arr[0]
             tb_msg = exc_arr[1]
@@ -213,3 +340,114 @@ def get_thread_pool(size=10, worker_factory=_worker_factory,
                     disable_threads=False):
     return ThreadPool(size=size, worker_factory=_worker_factory,
                       disable_threads=disable_threads)
+
+
+class HostLimiter(object):
+    """
+    Limits the number of concurrent operations (e.g. SSH channels) on each
+    host to max_per_host. A max_per_host of None or 0 disables the limit.
+    """
+    def __init__(self, max_per_host=None):
+        self.max_per_host = max_per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _get_semaphore(self, host):
+        with self._lock:
+            sem = self._semaphores.get(host)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self.max_per_host)
+                self._semaphores[host] = sem
+            return sem
+
+    def acquire(self, host, blocking=True):
+        """
+        Takes one of the host's slots. Returns False if blocking is False and
+        no slot is free.
+        """
+        if not self.max_per_host:
+            return True
+        return self._get_semaphore(host).acquire(blocking)
+
+    def release(self, host):
+        if self.max_per_host:
+            self._get_semaphore(host).release()
+
+    @contextlib.contextmanager
+    def limit(self, host):
+        self.acquire(host)
+        try:
+            yield
+        finally:
+            self.release(host)
+
+
+DEFAULT_MAX_THREADS = 20
+
+_shared_pool = None
+_shared_pool_size = DEFAULT_MAX_THREADS
+_shared_pool_lock = threading.Lock()
+_host_limiter = HostLimiter()
+
+
+def configure_shared_pool(max_threads=None, max_host_channels=None):
+    """
+    Set the global limits used by get_shared_pool and host_limit:
+
+    max_threads - number of threads of the process-wide shared pool. Only
+                  applies if the shared pool has not been created yet.
+    max_host_channels - max number of concurrent SSH channels to a host
+
+    Limits that are None are left unchanged.
+    """
+    global _shared_pool_size, _host_limiter
+    with _shared_pool_lock:
+        if max_threads:
+            if _shared_pool and max_threads != _shared_pool_size:
+                log.warn("The shared thread pool already has %d threads, "
+                         "ignoring max_threads=%d" % (_shared_pool_size,
+                                                      max_threads))
+            else:
+                _shared_pool_size = max_threads
+        if max_host_channels is not None:
+            _host_limiter = HostLimiter(max_host_channels)
+
+
+def configure_num_threads(num_threads):
+    """
+    Applies the deprecated num_threads setting of Cluster and
+    DefaultClusterSetup (and the plugins based on it) to the shared pool
+    """
+    log.warn("num_threads is deprecated and will be removed in a future "
+             "release: set max_threads in the [global] section instead")
+    configure_shared_pool(max_threads=int(num_threads))
+
+
+def get_shared_pool(disable_threads=False):
+    """
+    Returns the process-wide ThreadPool that cluster operations and plugins
+    share. The pool must not be shut down by its users.
+    """
+    global _shared_pool
+    if disable_threads:
+        return get_thread_pool(disable_threads=True)
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = get_thread_pool(size=_shared_pool_size)
+        return _shared_pool
+
+
+def get_host_limiter():
+    """
+    Returns the HostLimiter currently used by host_limit (see
+    configure_shared_pool)
+    """
+    return _host_limiter
+
+
+def host_limit(host):
+    """
+    Context manager that waits for one of the host's concurrency slots
+    (see configure_shared_pool)
+    """
+    return _host_limiter.limit(host)
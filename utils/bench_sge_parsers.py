@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Benchmarks SGEStats.parse_qstat and SGEStats.parse_qhost on the load balancer
+test fixtures scaled up to large queues and clusters, against building the
+minidom tree of the same output (what the parsers used to do).
+
+Each parser runs in its own child process, on its own output, so that the
+reported time and peak RSS belong to that parser alone. The input is built
+before parsing, so it is part of the "baseline" RSS and excluded from the
+increase over it ("delta").
+
+Usage: python utils/bench_sge_parsers.py [qstat|qhost] [size ...]
+
+The sizes are numbers of jobs for qstat (default: 1000 10000 50000) and
+numbers of hosts for qhost (default: 100 1000 5000). Both are benchmarked
+when neither is given.
+"""
+import os
+import sys
+import time
+import resource
+import subprocess
+import xml.dom.minidom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from starcluster.balancers import sge
+from starcluster.tests.templates import sge_balancer
+
+# jobs in the loaded_qstat_xml fixture
+FIXTURE_JOBS = 192
+# execution hosts in the loaded_qhost_xml fixture
+FIXTURE_HOSTS = 10
+
+
+def qstat_xml(num_jobs):
+    factor = max(1, num_jobs / FIXTURE_JOBS)
+    return (sge_balancer.scale_qstat_xml(sge_balancer.loaded_qstat_xml,
+                                         factor), FIXTURE_JOBS * factor)
+
+
+def qhost_xml(num_hosts):
+    factor = max(1, num_hosts / FIXTURE_HOSTS)
+    return (sge_balancer.scale_qhost_xml(sge_balancer.loaded_qhost_xml,
+                                         factor), FIXTURE_HOSTS * factor)
+
+
+def iterparse_qstat(xml_out):
+    return len(sge.SGEStats().parse_qstat(xml_out))
+
+
+def streamed_qstat(xml_out):
+    return iterparse_qstat(iter(xml_out.splitlines()))
+
+
+def minidom_qstat(xml_out):
+    doc = xml.dom.minidom.parseString(xml_out)
+    return len(doc.getElementsByTagName("job_list"))
+
+
+def iterparse_qhost(xml_out):
+    return len(sge.SGEStats().parse_qhost(xml_out))
+
+
+def streamed_qhost(xml_out):
+    return iterparse_qhost(iter(xml_out.splitlines()))
+
+
+def minidom_qhost(xml_out):
+    doc = xml.dom.minidom.parseString(xml_out)
+    # not counting the 'global' host
+    return len(doc.getElementsByTagName("host")) - 1
+
+
+BENCHMARKS = {
+    "qstat": (qstat_xml, [1000, 10000, 50000],
+              (("iterparse", iterparse_qstat), ("streamed", streamed_qstat),
+               ("minidom", minidom_qstat))),
+    "qhost": (qhost_xml, [100, 1000, 5000],
+              (("iterparse", iterparse_qhost), ("streamed", streamed_qhost),
+               ("minidom", minidom_qhost))),
+}
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(output, name, size):
+    """
+    Parse the output of the given size with the named parser and print the
+    number of jobs or hosts, the elapsed time, the peak RSS before parsing and
+    the peak RSS after parsing
+    """
+    get_xml, default_sizes, parsers = BENCHMARKS[output]
+    xml_out, expected = get_xml(size)
+    parser = dict(parsers)[name]
+    before = max_rss_mb()
+    start = time.time()
+    count = parser(xml_out)
+    elapsed = time.time() - start
+    assert count == expected
+    print "%d %f %f %f" % (count, elapsed, before, max_rss_mb())
+
+
+def main(outputs, sizes=None):
+    header = ("output", "size", "parser", "time", "baseline", "peak rss",
+              "delta")
+    print "%6s %10s %10s %10s %10s %10s %10s" % header
+    for output in outputs:
+        get_xml, default_sizes, parsers = BENCHMARKS[output]
+        for size in sizes or default_sizes:
+            for name, parser in parsers:
+                out = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), "--run",
+                     output, name, str(size)])
+                count, elapsed, before, peak = out.split()
+                print "%6s %10s %10s %9.3fs %8.1fMB %8.1fMB %8.1fMB" % (
+                    output, count, name, float(elapsed), float(before),
+                    float(peak), float(peak) - float(before))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args[:1] == ["--run"]:
+        run(args[1], args[2], int(args[3]))
+    elif args[:1] and args[0] in BENCHMARKS:
+        main(args[:1], [int(arg) for arg in args[1:]])
+    else:
+        main(["qstat", "qhost"], [int(arg) for arg in args])